@@ -0,0 +1,69 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Measure SQLite write throughput with per-write and group commits.
+
+Usage: python db_benchmark.py [number of writes]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# utils.config requires these even though the benchmark never talks to Telegram
+os.environ.setdefault("API_ID", "0")
+os.environ.setdefault("API_HASH", "0")
+os.environ.setdefault("STRINGSESSION", "")
+os.environ.setdefault("APIFLASH_KEY", "")
+os.environ["DATABASE_TYPE"] = "sqlite3"
+os.environ["DATABASE_NAME"] = os.path.join(tempfile.mkdtemp(), "default.sqlite3")
+
+from utils.db import SqliteDatabase  # noqa: E402
+
+
+def run(name: str, writes: int, **kwargs) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        database = SqliteDatabase(os.path.join(tmp, "bench.sqlite3"), **kwargs)
+        start = time.perf_counter()
+        for i in range(writes):
+            database.set("core.bench", f"counter{i % 100}", {"count": i})
+            if i % 10 == 0:
+                database.remove("core.bench", f"counter{(i + 50) % 100}")
+        database.close()
+        elapsed = time.perf_counter() - start
+
+    ops = writes / elapsed
+    print(f"{name:<40} {ops:>12,.0f} writes/sec")
+    return ops
+
+
+def main():
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"Writing {writes} values...\n")
+    before = run("rollback journal, commit per write", writes, wal=False)
+    run("WAL, commit per write", writes)
+    after = run(
+        "WAL, group commit (0.5s / 100 writes)",
+        writes,
+        commit_interval=0.5,
+        commit_every=100,
+    )
+    print(f"\nGroup commit speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -42,7 +42,11 @@
 #     "lexica-api",
 # ]
 # ///
+# first, so that the startup profiler sees every other import
+from utils import startup  # isort: skip
+
 import os
+import asyncio
 import logging
 
 import sqlite3
@@ -50,27 +54,37 @@ import platform
 import subprocess
 from pathlib import Path
 
+import aiohttp
 from pyrogram import Client, idle, errors
 from pyrogram.enums.parse_mode import ParseMode
 from pyrogram.raw.functions.account import GetAuthorizations, DeleteAccount
-import requests
 
 from utils import config
 from utils.db import db
-from utils.misc import gitrepo, userbot_version
-from utils.scripts import restart, load_module
+from utils.migrations import migrate_storage_layout
+from utils.misc import commit_hash, userbot_version
+from utils.prewarm import prewarm
+from utils.reloader import watch_modules
+from utils.scripts import (
+    restart,
+    load_modules,
+    import_times,
+    lazy_modules,
+)
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 if SCRIPT_PATH != os.getcwd():
     os.chdir(SCRIPT_PATH)
 
+startup.mark("imports")
+
 common_params = {
     "api_id": config.api_id,
     "api_hash": config.api_hash,
     "hide_password": True,
     "workdir": SCRIPT_PATH,
     "app_version": userbot_version,
-    "device_model": f"Moon-Userbot @ {gitrepo.head.commit.hexsha[:7]}",
+    "device_model": f"Moon-Userbot @ {commit_hash[:7]}",
     "system_version": platform.version() + " " + platform.machine(),
     "sleep_threshold": 30,
     "test_mode": config.test_server,
@@ -82,37 +96,104 @@ if config.STRINGSESSION:
 
 app = Client("my_account", **common_params)
 
+SESSION_LOCK_RETRIES = 4
+
+
+MODULES_REPO = (
+    "https://raw.githubusercontent.com/The-MoonTg-project/custom_modules/main"
+)
+CUSTOM_MODULES_PATH = f"{SCRIPT_PATH}/modules/custom_modules"
+# last fetched copy of full.txt, used when GitHub can't be reached
+MODULES_INDEX_CACHE = f"{CUSTOM_MODULES_PATH}/.full.txt"
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+
+
+async def fetch_modules_index(session: aiohttp.ClientSession) -> str | None:
+    """Fetch full.txt, revalidating the cached copy by its ETag"""
+    cached = None
+    if os.path.exists(MODULES_INDEX_CACHE):
+        with open(MODULES_INDEX_CACHE, encoding="utf-8") as f:
+            cached = f.read()
+
+    etag = db.get("custom.modules", "index_etag") if cached is not None else None
+    headers = {"If-None-Match": etag} if etag else {}
+    try:
+        async with session.get(f"{MODULES_REPO}/full.txt", headers=headers) as resp:
+            if resp.status == 304:
+                return cached
+            resp.raise_for_status()
+            text = await resp.text()
+            etag = resp.headers.get("ETag")
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        if cached is None:
+            logging.error("Failed to fetch custom modules list")
+        else:
+            logging.warning("Failed to fetch custom modules list, using cached copy")
+        return cached
+
+    with open(MODULES_INDEX_CACHE, "w", encoding="utf-8") as f:
+        f.write(text)
+    if etag:
+        db.set("custom.modules", "index_etag", etag)
+    return text
+
+
+async def download_module(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    module_name: str,
+    repo_path: str,
+):
+    module_path = f"{CUSTOM_MODULES_PATH}/{module_name}.py"
+    async with semaphore:
+        try:
+            async with session.get(f"{MODULES_REPO}/{repo_path}.py") as resp:
+                resp.raise_for_status()
+                content = await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.warning("Failed to load module: %s", module_name)
+            return
+
+    # write to a temporary file first so an interrupted download is never imported
+    with open(f"{module_path}.part", "wb") as f:
+        f.write(content)
+    os.replace(f"{module_path}.part", module_path)
+    logging.info("Loaded missing module: %s", module_name)
 
-def load_missing_modules():
+
+async def load_missing_modules():
     all_modules = db.get("custom.modules", "allModules", [])
     if not all_modules:
         return
 
-    custom_modules_path = f"{SCRIPT_PATH}/modules/custom_modules"
-    os.makedirs(custom_modules_path, exist_ok=True)
-
-    try:
-        f = requests.get(
-            "https://raw.githubusercontent.com/The-MoonTg-project/custom_modules/main/full.txt"
-        ).text
-    except Exception:
-        logging.error("Failed to fetch custom modules list")
+    os.makedirs(CUSTOM_MODULES_PATH, exist_ok=True)
+    missing = [
+        module_name
+        for module_name in all_modules
+        if not os.path.exists(f"{CUSTOM_MODULES_PATH}/{module_name}.py")
+    ]
+    if not missing:
         return
-    modules_dict = {
-        line.split("/")[-1].split()[0]: line.strip() for line in f.splitlines()
-    }
-
-    for module_name in all_modules:
-        module_path = f"{custom_modules_path}/{module_name}.py"
-        if not os.path.exists(module_path) and module_name in modules_dict:
-            url = f"https://raw.githubusercontent.com/The-MoonTg-project/custom_modules/main/{modules_dict[module_name]}.py"
-            resp = requests.get(url)
-            if resp.ok:
-                with open(module_path, "wb") as f:
-                    f.write(resp.content)
-                logging.info("Loaded missing module: %s", module_name)
-            else:
-                logging.warning("Failed to load module: %s", module_name)
+
+    async with aiohttp.ClientSession(timeout=DOWNLOAD_TIMEOUT) as session:
+        index = await fetch_modules_index(session)
+        if index is None:
+            return
+        modules_dict = {
+            line.split("/")[-1].split()[0]: line.strip()
+            for line in index.splitlines()
+            if line.strip()
+        }
+
+        semaphore = asyncio.Semaphore(DOWNLOAD_WORKERS)
+        await asyncio.gather(
+            *(
+                download_module(session, semaphore, name, modules_dict[name])
+                for name in missing
+                if name in modules_dict
+            )
+        )
 
 
 async def main():
@@ -124,7 +205,19 @@ async def main():
     DeleteAccount.__new__ = None
 
     try:
-        await app.start()
+        # another session may hold the session file for a moment, wait for it
+        # before resorting to killing the process that holds it
+        for attempt in range(SESSION_LOCK_RETRIES):
+            try:
+                await app.start()
+                break
+            except sqlite3.OperationalError as e:
+                if str(e) != "database is locked" or (
+                    attempt == SESSION_LOCK_RETRIES - 1
+                ):
+                    raise
+                logging.warning("Session file is locked, retrying...")
+                await asyncio.sleep(2**attempt)
     except sqlite3.OperationalError as e:
         if str(e) == "database is locked" and os.name == "posix":
             logging.warning(
@@ -139,26 +232,32 @@ async def main():
         )
         os.rename("./my_account.session", "./my_account.session-old")
         restart()
+    startup.mark("app.start")
 
-    load_missing_modules()
-    success_modules = 0
-    failed_modules = 0
-
-    for path in Path("modules").rglob("*.py"):
-        try:
-            await load_module(
-                path.stem, app, core="custom_modules" not in path.parent.parts
-            )
-        except Exception:
-            logging.warning("Can't import module %s", path.stem, exc_info=True)
-            failed_modules += 1
-        else:
-            success_modules += 1
+    migrate_storage_layout(db)
+    startup.mark("migrations")
+    await load_missing_modules()
+    startup.mark("missing modules download")
+    module_files = list(Path("modules").rglob("*.py"))
+    success_modules, failed_modules = await load_modules(
+        module_files, app, lazy=config.lazy_modules
+    )
+    startup.mark("module loading")
 
     logging.info("Imported %s modules", success_modules)
+    if lazy_modules:
+        logging.info("%s of them load on first use", len(lazy_modules))
     if failed_modules:
         logging.warning("Failed to import %s modules", failed_modules)
 
+    # requirements of modules that aren't imported yet and bytecode for the
+    # next restart, off the startup path
+    prewarm_task = asyncio.create_task(prewarm(module_files))
+    if config.hot_reload:
+        reload_task = asyncio.create_task(
+            watch_modules(app, config.hot_reload_interval)
+        )
+
     if info := db.get("core.updater", "restart_info"):
         text = {
             "restart": "<b>Restart completed!</b>",
@@ -169,6 +268,7 @@ async def main():
         except errors.RPCError:
             pass
         db.remove("core.updater", "restart_info")
+    startup.mark("restart message")
 
     # required for sessionkiller module
     if db.get("core.sessionkiller", "enabled", False):
@@ -180,11 +280,18 @@ async def main():
                 for auth in (await app.invoke(GetAuthorizations())).authorizations
             ],
         )
+        startup.mark("sessionkiller authorizations")
 
+    run = startup.finish(db, import_times)
+    # timeline and slowest modules, plus every import with --profile-startup
+    logging.info(startup.format_run(run))
     logging.info("Moon-Userbot started!")
 
     await idle()
 
+    prewarm_task.cancel()
+    if config.hot_reload:
+        reload_task.cancel()
     await app.stop()
 
 
@@ -15,6 +15,8 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 import humanize
@@ -22,15 +24,39 @@ from pyrogram import Client, filters
 from pyrogram.types import Message
 
 from utils.misc import modules_help, prefix
+from utils.ratelimit import limiter
 from utils.scripts import ReplyCheck
-from utils.db import db
-
-# Variables
-AFK = False
-AFK_REASON = ""
-AFK_TIME = ""
-USERS = {}
-GROUPS = {}
+from utils.db import db, adb
+
+# chats remembered while AFK, the least recently active are forgotten first
+MAX_CHATS = 1000
+# a chat that stayed quiet this long gets the first reply again
+CHAT_TTL = 6 * 60 * 60
+# messages from a chat after which it gets no more replies
+LAST_REPLY = 50
+# counters are saved at most this often, status changes right away
+SAVE_DELAY = 30
+
+DEFAULT_AFK_MSG = (
+    "<b>Beep boop. This is an automated message.\n"
+    "I am not available right now.\n"
+    "Last seen: {last_seen}\n"
+    "Reason: <code>{reason}</code>\n"
+    "See you after I'm done doing whatever I'm doing.</b>"
+)
+STILL_AFK_MSG = (
+    "<b>Hey I'm still not back yet.\n"
+    "Last seen: {last_seen}\n"
+    "Still busy: <code>{reason}</code>\n"
+    "Try pinging a bit later.</b>"
+)
+LAST_AFK_MSG = (
+    "<b>This is an automated message\n"
+    "Last seen: {last_seen}\n"
+    "This is the 10th time I've told you I'm AFK right now...\n"
+    "I'll get to you when I get to you.\n"
+    "No more auto messages for you</b>"
+)
 
 
 def GetChatID(message: Message):
@@ -44,107 +70,187 @@ def subtract_time(start, end):
     return str(subtracted)
 
 
+def prepare(template: str, reason: str) -> list:
+    """Fill in the reason once, last_seen goes between the returned parts"""
+    return template.format(last_seen="\0", reason=reason).split("\0")
+
+
+class AfkState:
+    """AFK status and per-chat counters, loaded once and saved in the background"""
+
+    def __init__(self):
+        saved = db.get_many(
+            "core.afk", ["active", "reason", "since", "chats", "totals", "afk_msg"]
+        )
+        self.active = bool(saved["active"])
+        self.reason = saved["reason"] or ""
+        self.since = saved["since"] or 0.0
+        self.afk_msg = saved["afk_msg"]
+        # chat id -> [messages received, time of the last one], oldest first
+        self.chats = OrderedDict(
+            (chat_id, [count, seen]) for chat_id, count, seen in saved["chats"] or ()
+        )
+        # messages and chats since going AFK, including forgotten chats
+        self.messages, self.chat_count = saved["totals"] or (0, 0)
+        self._save_task = None
+        self.prepare()
+
+    def prepare(self):
+        """Precompute the replies for the current reason and AFK message"""
+        self.still = prepare(STILL_AFK_MSG, self.reason.upper())
+        self.last = prepare(LAST_AFK_MSG, self.reason.upper())
+        # a custom AFK message gets "5 minutes" instead of "5 minutes ago"
+        self.custom = False
+        if self.afk_msg is not None:
+            try:
+                self.first = prepare(self.afk_msg, self.reason)
+                self.custom = True
+            except (IndexError, KeyError, ValueError):
+                pass
+        if not self.custom:
+            self.first = prepare(DEFAULT_AFK_MSG, self.reason.upper())
+
+    def reply_text(self, parts: list) -> str:
+        last_seen = subtract_time(datetime.now(), datetime.fromtimestamp(self.since))
+        if parts is self.first and self.custom:
+            last_seen = last_seen.replace("ago", "").strip()
+        return last_seen.join(parts)
+
+    def received(self, chat_id: int) -> list | None:
+        """Count a message, returns the parts of the reply if it needs one"""
+        now = time.time()
+        entry = self.chats.get(chat_id)
+        if entry is not None and entry[0] > LAST_REPLY and now - entry[1] < CHAT_TTL:
+            # still active, so the TTL starts over without another reply
+            entry[1] = now
+            self.chats.move_to_end(chat_id)
+            self.save(SAVE_DELAY)
+            return None
+
+        self.messages += 1
+        self.save(SAVE_DELAY)
+        if entry is None or now - entry[1] >= CHAT_TTL:
+            if entry is None:
+                self.chat_count += 1
+            self.chats[chat_id] = [1, now]
+            self.chats.move_to_end(chat_id)
+            self.forget(now)
+            return self.first
+
+        count = entry[0]
+        entry[0] += 1
+        entry[1] = now
+        self.chats.move_to_end(chat_id)
+        if count == LAST_REPLY:
+            return self.last
+        if count % 5 == 0:
+            return self.still
+        return None
+
+    def forget(self, now: float):
+        while self.chats:
+            chat_id, (_, seen) = next(iter(self.chats.items()))
+            if len(self.chats) <= MAX_CHATS and now - seen < CHAT_TTL:
+                break
+            del self.chats[chat_id]
+
+    def start(self, reason: str):
+        self.active = True
+        self.reason = reason
+        self.since = time.time()
+        self.chats.clear()
+        self.messages = self.chat_count = 0
+        self.prepare()
+        self.save()
+
+    def stop(self) -> str:
+        """Leave AFK, returns the summary"""
+        last_seen = subtract_time(datetime.now(), datetime.fromtimestamp(self.since))
+        summary = (
+            f"<code>While you were away (for {last_seen.replace('ago', '').strip()}),"
+            f" you received {self.messages} messages from {self.chat_count} chats"
+            "</code>"
+        )
+        self.active = False
+        self.reason = ""
+        self.since = 0.0
+        self.chats.clear()
+        self.messages = self.chat_count = 0
+        self.save()
+        return summary
+
+    def set_afk_msg(self, afk_msg: str):
+        self.afk_msg = afk_msg
+        self.prepare()
+
+    def save(self, delay: float = 0):
+        """Write the state to the database, a pending delayed save is enough"""
+        if self._save_task is not None and not self._save_task.done():
+            if delay:
+                return
+            self._save_task.cancel()
+        self._save_task = asyncio.create_task(self._save(delay))
+
+    async def _save(self, delay: float):
+        await asyncio.sleep(delay)
+        await adb.aset_many(
+            "core.afk",
+            {
+                "active": self.active,
+                "reason": self.reason,
+                "since": self.since,
+                "chats": [[chat_id, *entry] for chat_id, entry in self.chats.items()],
+                "totals": [self.messages, self.chat_count],
+            },
+        )
+
+
+afk = AfkState()
+
+
+async def afk_filter(_, __, ___):
+    return afk.active
+
+
+is_afk = filters.create(afk_filter)
+
+
+async def send_afk_reply(bot: Client, message: Message, text: str):
+    """Reply unless the chat got too many automatic replies lately"""
+    if limiter.allow("afk", GetChatID(message)):
+        await bot.send_message(
+            chat_id=GetChatID(message),
+            text=text,
+            reply_to_message_id=ReplyCheck(message),
+        )
+
+
 # Main
 
 
 @Client.on_message(
-    ((filters.group & filters.mentioned) | filters.private)
+    is_afk
+    & ((filters.group & filters.mentioned) | filters.private)
     & ~filters.me
     & ~filters.service,
     group=3,
 )
 async def collect_afk_messages(bot: Client, message: Message):
-    if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME)
-        is_group = message.chat.type in ["supergroup", "group"]
-        CHAT_TYPE = GROUPS if is_group else USERS
-
-        if GetChatID(message) not in CHAT_TYPE:
-            text = db.get("core.afk", "afk_msg", None)
-            if text is None:
-                text = (
-                    f"<b>Beep boop. This is an automated message.\n"
-                    f"I am not available right now.\n"
-                    f"Last seen: {last_seen}\n"
-                    f"Reason: <code>{AFK_REASON.upper()}</code>\n"
-                    f"See you after I'm done doing whatever I'm doing.</b>"
-                )
-            else:
-                last_seen = last_seen.replace("ago", "").strip()
-                text = text.format(last_seen=last_seen, reason=AFK_REASON)
-            await bot.send_message(
-                chat_id=GetChatID(message),
-                text=text,
-                reply_to_message_id=ReplyCheck(message),
-            )
-            CHAT_TYPE[GetChatID(message)] = 1
-            return
-        if GetChatID(message) in CHAT_TYPE:
-            if CHAT_TYPE[GetChatID(message)] == 50:
-                text = (
-                    f"<b>This is an automated message\n"
-                    f"Last seen: {last_seen}\n"
-                    f"This is the 10th time I've told you I'm AFK right now...\n"
-                    f"I'll get to you when I get to you.\n"
-                    f"No more auto messages for you</b>"
-                )
-                await bot.send_message(
-                    chat_id=GetChatID(message),
-                    text=text,
-                    reply_to_message_id=ReplyCheck(message),
-                )
-            elif CHAT_TYPE[GetChatID(message)] > 50:
-                return
-            elif CHAT_TYPE[GetChatID(message)] % 5 == 0:
-                text = (
-                    f"<b>Hey I'm still not back yet.\n"
-                    f"Last seen: {last_seen}\n"
-                    f"Still busy: <code>{AFK_REASON.upper()}</code>\n"
-                    f"Try pinging a bit later.</b>"
-                )
-                await bot.send_message(
-                    chat_id=GetChatID(message),
-                    text=text,
-                    reply_to_message_id=ReplyCheck(message),
-                )
-
-        CHAT_TYPE[GetChatID(message)] += 1
+    parts = afk.received(GetChatID(message))
+    if parts is not None:
+        await send_afk_reply(bot, message, afk.reply_text(parts))
 
 
 @Client.on_message(filters.command("afk", prefix) & filters.me, group=3)
 async def afk_set(_, message: Message):
-    global AFK_REASON, AFK, AFK_TIME
-
-    cmd = message.command
-    afk_text = ""
-
-    if len(cmd) > 1:
-        afk_text = " ".join(cmd[1:])
-
-    if isinstance(afk_text, str):
-        AFK_REASON = afk_text
-
-    AFK = True
-    AFK_TIME = datetime.now()
-
+    afk.start(" ".join(message.command[1:]))
     await message.delete()
 
 
 @Client.on_message(filters.command("afk", "!") & filters.me, group=3)
 async def afk_unset(_, message: Message):
-    global AFK, AFK_TIME, AFK_REASON, USERS, GROUPS
-
-    if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME).replace("ago", "").strip()
-        await message.edit(
-            f"<code>While you were away (for {last_seen}), you received {sum(USERS.values()) + sum(GROUPS.values())} "
-            f"messages from {len(USERS) + len(GROUPS)} chats</code>",
-        )
-        AFK = False
-        AFK_TIME = ""
-        AFK_REASON = ""
-        USERS = {}
-        GROUPS = {}
+    if afk.active:
+        await message.edit(afk.stop())
         await asyncio.sleep(5)
 
     await message.delete()
@@ -180,26 +286,15 @@ async def set_afk_msg(_, message: Message):
     if old_afk_msg:
         db.remove("core.afk", "afk_msg")
     db.set("core.afk", "afk_msg", afk_msg)
+    afk.set_afk_msg(afk_msg)
     await message.edit(f"AFK message set to:\n\n{afk_msg}")
 
 
-@Client.on_message(filters.me, group=3)
+@Client.on_message(is_afk & filters.me, group=3)
 async def auto_afk_unset(_, message: Message):
-    global AFK, AFK_TIME, AFK_REASON, USERS, GROUPS
-
-    if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME).replace("ago", "").strip()
-        reply = await message.reply(
-            f"<code>While you were away (for {last_seen}), you received {sum(USERS.values()) + sum(GROUPS.values())} "
-            f"messages from {len(USERS) + len(GROUPS)} chats</code>"
-        )
-        AFK = False
-        AFK_TIME = ""
-        AFK_REASON = ""
-        USERS = {}
-        GROUPS = {}
-        await asyncio.sleep(5)
-        await reply.delete()
+    reply = await message.reply(afk.stop())
+    await asyncio.sleep(5)
+    await reply.delete()
 
 
 modules_help["afk"] = {
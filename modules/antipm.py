@@ -19,36 +19,78 @@ from pyrogram.raw import functions
 from pyrogram.types import Message
 
 from utils.config import pm_limit
-from utils.db import db
+from utils.db import db, adb
 from utils.misc import modules_help, prefix
+from utils.ratelimit import limiter
 
-anti_pm_enabled = filters.create(
-    lambda _, __, ___: db.get("core.antipm", "status", False)
-)
+SETTINGS_VARS = ["status", "antipm_msg", "antipm_pic", "spamrep", "block"]
+# core.antipm, read once and updated by the commands below
+SETTINGS = db.get_many("core.antipm", SETTINGS_VARS)
+# ids of approved users
+APPROVED = set(db.get_collection("core.antipm.allowed"))
+# user id -> warnings, cached from core.antipm.warns
+WARNS = {}
+
+
+def set_setting(variable: str, value):
+    db.set("core.antipm", variable, value)
+    SETTINGS[variable] = value
+
+
+async def get_warns(user_id: int) -> int:
+    if user_id not in WARNS:
+        warns = await adb.aget("core.antipm.warns", str(user_id), 0)
+        # another message of the user may have been counted meanwhile
+        WARNS.setdefault(user_id, warns)
+    return WARNS[user_id]
+
+
+def add_warn(user_id: int) -> int:
+    """Count a warning before any await, so concurrent messages all count"""
+    WARNS[user_id] += 1
+    return WARNS[user_id]
+
+
+async def save_warns(user_id: int):
+    if user_id in WARNS:
+        await adb.aset("core.antipm.warns", str(user_id), WARNS[user_id])
+
+
+async def reset_warns(user_id: int):
+    WARNS.pop(user_id, None)
+    await adb.aremove("core.antipm.warns", str(user_id))
+
+
+async def anti_pm_filter(_, __, ___):
+    return bool(SETTINGS["status"])
+
+
+anti_pm_enabled = filters.create(anti_pm_filter)
 
 in_contact_list = filters.create(lambda _, __, message: message.from_user.is_contact)
 
 is_support = filters.create(lambda _, __, message: message.chat.is_support)
 
-USER_WARNINGS = {}
-
 
 @Client.on_message(
-    filters.private
+    anti_pm_enabled
+    & filters.private
     & ~filters.me
     & ~filters.bot
     & ~in_contact_list
     & ~is_support
-    & anti_pm_enabled
 )
 async def anti_pm_handler(client: Client, message: Message):
     user_id = message.from_user.id
     ids = message.chat.id
-    b_f = await client.get_me()
-    u_n = b_f.first_name
-    user = await client.get_users(ids)
-    u_f = user.first_name
-    default_text = db.get("core.antipm", "antipm_msg", None)
+    me = client.me or await client.get_me()
+    u_n = me.first_name
+    u_f = message.from_user.first_name
+    warns = await get_warns(user_id)
+    approved = str(user_id) in APPROVED
+    if not approved:
+        count = add_warn(user_id)
+    default_text = SETTINGS["antipm_msg"]
     if default_text is None:
         default_text = f"""<b>Hello, {u_f}!
 This is the Assistant Of {u_n}.</b>
@@ -56,49 +98,44 @@ This is the Assistant Of {u_n}.</b>
 Do not spam further messages else I may have to block you!</i>
 
 <b>This is an automated message by the assistant.</b>
-<b><u>Currently You Have <code>{USER_WARNINGS.get(user_id, 0)}</code> Warnings.</u></b>
+<b><u>Currently You Have <code>{warns}</code> Warnings.</u></b>
     """
     else:
-        default_text = default_text.format(
-            user=u_f, my_name=u_n, warns=USER_WARNINGS.get(user_id, 0)
-        )
+        default_text = default_text.format(user=u_f, my_name=u_n, warns=warns)
 
-    if db.get("core.antipm", "spamrep", False):
+    if SETTINGS["spamrep"]:
         user_info = await client.resolve_peer(ids)
         await client.invoke(functions.messages.ReportSpam(peer=user_info))
 
-    if db.get("core.antipm", "block", False):
+    if SETTINGS["block"]:
         await client.block_user(user_id)
 
-    if db.get("core.antipm", f"disallowusers{ids}") == user_id != db.get(
-        "core.antipm", f"allowusers{ids}"
-    ) or db.get("core.antipm", f"disallowusers{ids}") != user_id != db.get(
-        "core.antipm", f"allowusers{ids}"
-    ):
-        default_pic = db.get("core.antipm", "antipm_pic", None)
-        if default_pic:
-            await client.send_photo(message.chat.id, default_pic, caption=default_text)
-        else:
-            await client.send_message(message.chat.id, default_text)
-
-        if user_id in USER_WARNINGS:
-            USER_WARNINGS[user_id] += 1
-        else:
-            USER_WARNINGS[user_id] = 1
-
-        if USER_WARNINGS[user_id] > pm_limit:
+    if not approved:
+        # warnings still count when the reply is skipped, so flooding gets blocked
+        if limiter.allow("antipm", message.chat.id):
+            default_pic = SETTINGS["antipm_pic"]
+            if default_pic:
+                await client.send_photo(
+                    message.chat.id, default_pic, caption=default_text
+                )
+            else:
+                await client.send_message(message.chat.id, default_text)
+
+        if count > pm_limit:
             await client.send_message(
                 message.chat.id,
                 "<b>Ehm...! That was your Last warn, Bye Bye see you L0L</b>",
             )
             await client.block_user(user_id)
-            del USER_WARNINGS[user_id]
+            await reset_warns(user_id)
+        else:
+            await save_warns(user_id)
 
 
 @Client.on_message(filters.command(["antipm", "anti_pm"], prefix) & filters.me)
 async def anti_pm(_, message: Message):
     if len(message.command) == 1:
-        if db.get("core.antipm", "status", False):
+        if SETTINGS["status"]:
             await message.edit(
                 "<b>Anti-PM status: enabled\n"
                 f"Disable with: </b><code>{prefix}antipm disable</code>"
@@ -109,10 +146,10 @@ async def anti_pm(_, message: Message):
                 f"Enable with: </b><code>{prefix}antipm enable</code>"
             )
     elif message.command[1] in ["enable", "on", "1", "yes", "true"]:
-        db.set("core.antipm", "status", True)
+        set_setting("status", True)
         await message.edit("<b>Anti-PM enabled!</b>")
     elif message.command[1] in ["disable", "off", "0", "no", "false"]:
-        db.set("core.antipm", "status", False)
+        set_setting("status", False)
         await message.edit("<b>Anti-PM disabled!</b>")
     else:
         await message.edit(f"<b>Usage: {prefix}antipm [enable|disable]</b>")
@@ -121,7 +158,7 @@ async def anti_pm(_, message: Message):
 @Client.on_message(filters.command(["antipm_report"], prefix) & filters.me)
 async def antipm_report(_, message: Message):
     if len(message.command) == 1:
-        if db.get("core.antipm", "spamrep", False):
+        if SETTINGS["spamrep"]:
             await message.edit(
                 "<b>Spam-reporting enabled.\n"
                 f"Disable with: </b><code>{prefix}antipm_report disable</code>"
@@ -132,10 +169,10 @@ async def antipm_report(_, message: Message):
                 f"Enable with: </b><code>{prefix}antipm_report enable</code>"
             )
     elif message.command[1] in ["enable", "on", "1", "yes", "true"]:
-        db.set("core.antipm", "spamrep", True)
+        set_setting("spamrep", True)
         await message.edit("<b>Spam-reporting enabled!</b>")
     elif message.command[1] in ["disable", "off", "0", "no", "false"]:
-        db.set("core.antipm", "spamrep", False)
+        set_setting("spamrep", False)
         await message.edit("<b>Spam-reporting disabled!</b>")
     else:
         await message.edit(f"<b>Usage: {prefix}antipm_report [enable|disable]</b>")
@@ -144,7 +181,7 @@ async def antipm_report(_, message: Message):
 @Client.on_message(filters.command(["antipm_block"], prefix) & filters.me)
 async def antipm_block(_, message: Message):
     if len(message.command) == 1:
-        if db.get("core.antipm", "block", False):
+        if SETTINGS["block"]:
             await message.edit(
                 "<b>Blocking users enabled.\n"
                 f"Disable with: </b><code>{prefix}antipm_block disable</code>"
@@ -155,10 +192,10 @@ async def antipm_block(_, message: Message):
                 f"Enable with: </b><code>{prefix}antipm_block enable</code>"
             )
     elif message.command[1] in ["enable", "on", "1", "yes", "true"]:
-        db.set("core.antipm", "block", True)
+        set_setting("block", True)
         await message.edit("<b>Blocking users enabled!</b>")
     elif message.command[1] in ["disable", "off", "0", "no", "false"]:
-        db.set("core.antipm", "block", False)
+        set_setting("block", False)
         await message.edit("<b>Blocking users disabled!</b>")
     else:
         await message.edit(f"<b>Usage: {prefix}antipm_block [enable|disable]</b>")
@@ -168,9 +205,9 @@ async def antipm_block(_, message: Message):
 async def add_contact(_, message: Message):
     ids = message.chat.id
 
-    db.set("core.antipm", f"allowusers{ids}", ids)
-    if ids in USER_WARNINGS:
-        del USER_WARNINGS[ids]
+    db.set("core.antipm.allowed", str(ids), True)
+    APPROVED.add(str(ids))
+    await reset_warns(ids)
     await message.edit("User Approved!")
 
 
@@ -178,15 +215,15 @@ async def add_contact(_, message: Message):
 async def del_contact(_, message: Message):
     ids = message.chat.id
 
-    db.set("core.antipm", f"disallowusers{ids}", ids)
-    db.remove("core.antipm", f"allowusers{ids}")
+    db.remove("core.antipm.allowed", str(ids))
+    APPROVED.discard(str(ids))
     await message.edit("User DisApproved!")
 
 
 @Client.on_message(filters.command(["setantipmmsg", "sam"], prefix) & filters.me)
 async def set_antipm_msg(_, message: Message):
     if not message.reply_to_message:
-        db.set("core.antipm", "antipm_msg", None)
+        set_setting("antipm_msg", None)
         await message.edit("antipm message set to default.")
         return
 
@@ -216,27 +253,21 @@ async def set_antipm_msg(_, message: Message):
             "antipm message must contain <code>{warns}</code> to mention the warns count."
         )
 
-    old_afk_msg = db.get("core.antipm", "antipm_msg", None)
-    if old_afk_msg:
-        db.remove("core.antipm", "antipm_msg")
-    db.set("core.antipm", "antipm_msg", afk_msg)
+    set_setting("antipm_msg", afk_msg)
     await message.edit(f"antipm message set to:\n\n{afk_msg}")
 
 
 @Client.on_message(filters.command(["setantipmpic", "sap"], prefix) & filters.me)
 async def set_antipm_pic(_, message: Message):
     if not message.reply_to_message or not message.reply_to_message.photo:
-        db.set("core.antipm", "antipm_pic", None)
+        set_setting("antipm_pic", None)
         await message.edit("antipm picture set to default.")
         return
 
     photo = message.reply_to_message.photo
     file_id = photo.file_id
 
-    old_antipm_pic = db.get("core.antipm", "antipm_pic", None)
-    if old_antipm_pic:
-        db.remove("core.antipm", "antipm_pic")
-    db.set("core.antipm", "antipm_pic", file_id)
+    set_setting("antipm_pic", file_id)
     await message.edit("antipm picture set successfully.")
 
 
@@ -4,13 +4,18 @@ from pyrogram.types import Message
 from utils.misc import modules_help, prefix
 from utils.config import cohere_key
 from utils.db import db
-from utils.scripts import format_exc, import_library, restart
+from utils.scripts import format_exc, import_library
 
 cohere = import_library("cohere")
 
 co = cohere.Client(cohere_key)
 
-chatai_users = db.getaiusers()
+# a live set: users added or removed below are picked up by the next message
+chatai_users = filters.user(users=db.getaiusers())
+
+# stored turns per user and how much of them is sent back to the model
+HISTORY_LIMIT = 200
+HISTORY_MAX_TOKENS = 4000
 
 
 @Client.on_message(filters.command("addai", prefix))
@@ -20,8 +25,8 @@ async def adduser(_, message: Message):
         if user_id.isdigit():
             user_id = int(user_id)
             db.addaiuser(user_id)
+            chatai_users.add(user_id)
             await message.edit_text("<b>User ID Added</b>")
-            restart()
         else:
             await message.edit_text("<b>User ID is invalid.</b>")
             return
@@ -35,8 +40,8 @@ async def remuser(_, message: Message):
         if user_id.isdigit():
             user_id = int(user_id)
             db.remaiuser(user_id)
+            chatai_users.discard(user_id)
             await message.edit_text("<b>User ID Removed successfully</b>")
-            restart()
         else:
             await message.edit_text("<b>User ID is invalid.</b>")
             return
@@ -45,7 +50,7 @@ async def remuser(_, message: Message):
         return
 
 
-@Client.on_message(filters.user(users=chatai_users) & filters.text)
+@Client.on_message(chatai_users & filters.text)
 async def chatbot(_, message: Message):
     user_id = message.chat.id
 
@@ -56,11 +61,15 @@ async def chatbot(_, message: Message):
     try:
         await message.reply_chat_action(enums.ChatAction.TYPING)
 
-        chat_history = db.get_chat_history(user_id)
+        chat_history = db.get_chat_history(
+            user_id, limit=HISTORY_LIMIT, max_tokens=HISTORY_MAX_TOKENS
+        )
 
         prompt = message.text
 
-        db.add_chat_history(user_id, {"role": "USER", "message": prompt})
+        db.add_chat_history(
+            user_id, {"role": "USER", "message": prompt}, limit=HISTORY_LIMIT
+        )
 
         response = co.chat(
             chat_history=chat_history,
@@ -71,7 +80,11 @@ async def chatbot(_, message: Message):
             prompt_truncation="AUTO",
         )
 
-        db.add_chat_history(user_id, {"role": "CHATBOT", "message": response.text})
+        db.add_chat_history(
+            user_id,
+            {"role": "CHATBOT", "message": response.text},
+            limit=HISTORY_LIMIT,
+        )
 
         await message.reply_text(
             f"{response.text}", parse_mode=enums.ParseMode.MARKDOWN
@@ -84,14 +97,14 @@ async def chatbot(_, message: Message):
 @Client.on_message(filters.command("chatoff", prefix) & filters.me)
 async def chatoff(_, message: Message):
     db.remove("core.chatbot", "chatai_users")
+    chatai_users.clear()
     await message.reply_text("<b>ChatBot is off now</b>")
-    restart()
 
 
 @Client.on_message(filters.command("listai", prefix) & filters.me)
 async def listai(_, message: Message):
     await message.edit_text(
-        f"<b>User ID's Currently in AI ChatBot List:</b>\n <code>{chatai_users}</code>"
+        f"<b>User ID's Currently in AI ChatBot List:</b>\n <code>{sorted(chatai_users)}</code>"
     )
 
 
@@ -0,0 +1,132 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import time
+
+from pyrogram import Client, filters
+from pyrogram.types import Message
+
+from utils import dbdump
+from utils.db import db
+from utils.misc import modules_help, prefix
+from utils.scripts import format_exc, restart
+
+
+def format_db_stats() -> str:
+    cache = db.cache_stats()
+    lookups = cache["hits"] + cache["misses"]
+    hit_rate = cache["hits"] / lookups * 100 if lookups else 0
+
+    text = (
+        f"<b>Backend:</b> <code>{type(db.backend).__name__}</code>\n"
+        f"<b>Cache:</b> <code>{cache['size']}/{cache['max_size']}</code> values, "
+        f"<code>{cache['hits']}</code> hits, <code>{cache['misses']}</code> misses "
+        f"(<code>{hit_rate:.1f}%</code>)\n\n"
+        "<b>Backend latency, ms (p50 / p95 / p99 / max):</b>\n"
+    )
+
+    latency = db.latency.summary()
+    if not latency:
+        return text + f"<i>No queries yet, run</i> <code>{prefix}dbstat probe</code>"
+
+    for op, stats in sorted(latency.items()):
+        text += (
+            f"<code>{op}</code> ×{stats['count']}: <code>{stats['p50']:.2f}</code> / "
+            f"<code>{stats['p95']:.2f}</code> / <code>{stats['p99']:.2f}</code> / "
+            f"<code>{stats['max']:.2f}</code>\n"
+        )
+    return text
+
+
+@Client.on_message(filters.command(["dbstat"], prefix) & filters.me)
+async def dbstat(_, message: Message):
+    try:
+        if len(message.command) > 1 and message.command[1] == "probe":
+            await message.edit("<b>Probing database...</b>")
+            await asyncio.get_running_loop().run_in_executor(None, db.probe)
+        elif len(message.command) > 1 and message.command[1] == "reset":
+            db.latency.reset()
+        await message.edit(format_db_stats())
+    except Exception as e:
+        await message.edit(format_exc(e))
+
+
+@Client.on_message(filters.command(["dbdump"], prefix) & filters.me)
+async def db_dump(client: Client, message: Message):
+    await message.edit("<b>Dumping database...</b>")
+    path = f"moon_db_{int(time.time())}.ndjson.gz"
+    try:
+        rows, seconds = await asyncio.get_running_loop().run_in_executor(
+            None, dbdump.dump, db, path
+        )
+        await client.send_document(
+            message.chat.id,
+            path,
+            caption=f"<b>{rows} rows dumped in {seconds:.2f}s "
+            f"({rows / max(seconds, 1e-9):.0f} rows/sec)</b>",
+        )
+        await message.delete()
+    except Exception as e:
+        await message.edit(format_exc(e))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@Client.on_message(filters.command(["dbload"], prefix) & filters.me)
+async def db_load(_, message: Message):
+    if not message.reply_to_message or not message.reply_to_message.document:
+        return await message.edit(
+            f"<b>Reply to a file made by</b> <code>{prefix}dbdump</code>"
+        )
+
+    await message.edit("<b>Loading database...</b>")
+    path = None
+    try:
+        path = await message.reply_to_message.download()
+        rows, seconds = await asyncio.get_running_loop().run_in_executor(
+            None, dbdump.load, db, path
+        )
+        await message.edit(
+            f"<b>{rows} rows loaded in {seconds:.2f}s "
+            f"({rows / max(seconds, 1e-9):.0f} rows/sec)\nRestarting...</b>"
+        )
+        db.set(
+            "core.updater",
+            "restart_info",
+            {
+                "type": "restart",
+                "chat_id": message.chat.id,
+                "message_id": message.id,
+            },
+        )
+        restart()
+    except Exception as e:
+        await message.edit(format_exc(e))
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+modules_help["dbstat"] = {
+    "dbstat": "Show database cache and latency stats",
+    "dbstat probe": "Measure get/set/remove latency of the database backend",
+    "dbstat reset": "Reset collected latency stats",
+    "dbdump": "Export the whole database to a compressed file",
+    "dbload [reply to file]*": "Import a file made by dbdump and restart",
+}
@@ -14,6 +14,9 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+from collections import OrderedDict
+
 from pyrogram import Client, ContinuePropagation, errors, filters
 from pyrogram.types import (
     InputMediaAudio,
@@ -23,107 +26,238 @@ from pyrogram.types import (
     Message,
 )
 
-from utils.db import db
+from utils.db import db, adb
 from utils.misc import modules_help, prefix
+from utils.ratelimit import limiter
 from utils.scripts import format_exc
+from utils.triggers import CONTAINS, EXACT, PREFIX, REGEX, WORD, TriggerIndex
+
+# compiled triggers per chat, loaded on the first message from that chat,
+# the least recently active chats are dropped first
+TRIGGERS = OrderedDict()
+TRIGGERS_SIZE = 1024
+
+TRIGGER_FLAGS = {"-w": WORD, "-p": PREFIX, "-c": CONTAINS, "-r": REGEX}
+
+
+async def get_triggers(chat_id) -> TriggerIndex:
+    index = TRIGGERS.get(chat_id)
+    if index is None:
+        filters_ = await adb.aget_collection(f"core.filters.{chat_id}")
+        index = TriggerIndex(
+            {name: value.get("TYPE", EXACT) for name, value in filters_.items()}
+        )
+        TRIGGERS[chat_id] = index
+        if len(TRIGGERS) > TRIGGERS_SIZE:
+            TRIGGERS.popitem(last=False)
+    else:
+        TRIGGERS.move_to_end(chat_id)
+    return index
+
+
+def get_filter(chat_id, name):
+    return db.get(f"core.filters.{chat_id}", name)
 
 
-def get_filters_chat(chat_id):
-    return db.get("core.filters", f"{chat_id}", {})
+def set_filter(chat_id, name, filter_):
+    db.set(f"core.filters.{chat_id}", name, filter_)
+    if chat_id in TRIGGERS:
+        TRIGGERS[chat_id].add(name, filter_.get("TYPE", EXACT))
 
 
-def set_filters_chat(chat_id, filters_):
-    return db.set("core.filters", f"{chat_id}", filters_)
+def remove_filter(chat_id, name):
+    db.remove(f"core.filters.{chat_id}", name)
+    if chat_id in TRIGGERS:
+        TRIGGERS[chat_id].remove(name)
+
+
+def find_filter(chat_id, name):
+    """Look up a filter by name as typed (for regexes) or lowercased"""
+    for candidate in (name, name.lower()):
+        value = get_filter(chat_id, candidate)
+        if value is not None:
+            return candidate, value
+    return name.lower(), None
+
+
+def parse_trigger(args: str):
+    """Split '[-w|-p|-c|-r] name' into the name and the trigger type"""
+    flag, _, rest = args.partition(" ")
+    if flag in TRIGGER_FLAGS and rest.strip():
+        type_, name = TRIGGER_FLAGS[flag], rest.strip()
+    else:
+        type_, name = EXACT, args
+    return (name if type_ == REGEX else name.lower()), type_
 
 
 async def contains_filter(_, __, m):
-    return m.text and m.text.lower() in get_filters_chat(m.chat.id).keys()
+    if not m.text:
+        return False
+    trigger = (await get_triggers(m.chat.id)).match(m.text)
+    if trigger is None:
+        return False
+    # read by the handler below
+    m.filter_trigger = trigger
+    return True
 
 
 contains = filters.create(contains_filter)
 
 
-# noinspection PyTypeChecker
-@Client.on_message(contains)
-async def filters_main_handler(client: Client, message: Message):
-    value = get_filters_chat(message.chat.id)[message.text.lower()]
-    try:
-        await client.get_messages(int(value["CHAT_ID"]), int(value["MESSAGE_ID"]))
-    except errors.RPCError as exc:
-        raise ContinuePropagation from exc
-
-    if value.get("MEDIA_GROUP"):
-        messages_grouped = await client.get_media_group(
-            int(value["CHAT_ID"]), int(value["MESSAGE_ID"])
-        )
-        media_grouped_list = []
-        for _ in messages_grouped:
-            if _.photo:
-                if _.caption:
+def build_media_group(messages) -> list:
+    media_grouped_list = []
+    for _ in messages:
+        if _.photo:
+            if _.caption:
+                media_grouped_list.append(
+                    InputMediaPhoto(_.photo.file_id, _.caption.HTML)
+                )
+            else:
+                media_grouped_list.append(InputMediaPhoto(_.photo.file_id))
+        elif _.video:
+            if _.caption:
+                if _.video.thumbs:
                     media_grouped_list.append(
-                        InputMediaPhoto(_.photo.file_id, _.caption.HTML)
-                    )
-                else:
-                    media_grouped_list.append(InputMediaPhoto(_.photo.file_id))
-            elif _.video:
-                if _.caption:
-                    if _.video.thumbs:
-                        media_grouped_list.append(
-                            InputMediaVideo(
-                                _.video.file_id,
-                                _.video.thumbs[0].file_id,
-                                _.caption.HTML,
-                            )
-                        )
-                    else:
-                        media_grouped_list.append(
-                            InputMediaVideo(_.video.file_id, _.caption.HTML)
+                        InputMediaVideo(
+                            _.video.file_id,
+                            _.video.thumbs[0].file_id,
+                            _.caption.HTML,
                         )
-                elif _.video.thumbs:
-                    media_grouped_list.append(
-                        InputMediaVideo(_.video.file_id, _.video.thumbs[0].file_id)
                     )
                 else:
-                    media_grouped_list.append(InputMediaVideo(_.video.file_id))
-            elif _.audio:
-                if _.caption:
                     media_grouped_list.append(
-                        InputMediaAudio(_.audio.file_id, _.caption.HTML)
+                        InputMediaVideo(_.video.file_id, _.caption.HTML)
                     )
-                else:
-                    media_grouped_list.append(InputMediaAudio(_.audio.file_id))
-            elif _.document:
-                if _.caption:
-                    if _.document.thumbs:
-                        media_grouped_list.append(
-                            InputMediaDocument(
-                                _.document.file_id,
-                                _.document.thumbs[0].file_id,
-                                _.caption.HTML,
-                            )
-                        )
-                    else:
-                        media_grouped_list.append(
-                            InputMediaDocument(_.document.file_id, _.caption.HTML)
-                        )
-                elif _.document.thumbs:
+            elif _.video.thumbs:
+                media_grouped_list.append(
+                    InputMediaVideo(_.video.file_id, _.video.thumbs[0].file_id)
+                )
+            else:
+                media_grouped_list.append(InputMediaVideo(_.video.file_id))
+        elif _.audio:
+            if _.caption:
+                media_grouped_list.append(
+                    InputMediaAudio(_.audio.file_id, _.caption.HTML)
+                )
+            else:
+                media_grouped_list.append(InputMediaAudio(_.audio.file_id))
+        elif _.document:
+            if _.caption:
+                if _.document.thumbs:
                     media_grouped_list.append(
                         InputMediaDocument(
-                            _.document.file_id, _.document.thumbs[0].file_id
+                            _.document.file_id,
+                            _.document.thumbs[0].file_id,
+                            _.caption.HTML,
                         )
                     )
                 else:
-                    media_grouped_list.append(InputMediaDocument(_.document.file_id))
-        await client.send_media_group(
-            message.chat.id, media_grouped_list, reply_to_message_id=message.id
-        )
+                    media_grouped_list.append(
+                        InputMediaDocument(_.document.file_id, _.caption.HTML)
+                    )
+            elif _.document.thumbs:
+                media_grouped_list.append(
+                    InputMediaDocument(_.document.file_id, _.document.thumbs[0].file_id)
+                )
+            else:
+                media_grouped_list.append(InputMediaDocument(_.document.file_id))
+    return media_grouped_list
+
+
+def build_reply(stored: Message) -> dict:
+    """Arguments to send a stored message again, copied if it isn't text or a file"""
+    if stored.text:
+        return {"text": str(stored.text), "entities": stored.entities}
+    media = getattr(stored, stored.media.value, None) if stored.media else None
+    if getattr(media, "file_id", None):
+        return {
+            "file_id": media.file_id,
+            "caption": str(stored.caption or ""),
+            "caption_entities": stored.caption_entities,
+        }
+    return {"from_chat_id": stored.chat.id, "message_id": stored.id}
+
+
+async def resolve_reply(client: Client, chat_id: int, message_id: int) -> dict:
+    stored = await client.get_messages(chat_id, message_id)
+    if stored.empty:
+        raise errors.MessageIdInvalid()
+    return build_reply(stored)
+
+
+async def send_reply(client: Client, message: Message, reply: dict):
+    if "text" in reply:
+        send = client.send_message
+    elif "file_id" in reply:
+        send = client.send_cached_media
     else:
-        await client.copy_message(
-            message.chat.id,
-            int(value["CHAT_ID"]),
-            int(value["MESSAGE_ID"]),
-            reply_to_message_id=message.id,
-        )
+        send = client.copy_message
+    return await send(message.chat.id, reply_to_message_id=message.id, **reply)
+
+
+async def resolve_media_group(client: Client, chat_id: int, message_id: int) -> list:
+    return build_media_group(await client.get_media_group(chat_id, message_id))
+
+
+async def send_media_group(client: Client, message: Message, media: list):
+    return await client.send_media_group(
+        message.chat.id, media, reply_to_message_id=message.id
+    )
+
+
+# what filters send by (chat id, message id of the stored message): send_reply
+# arguments or InputMedia lists, reused until sending them fails
+REPLIES = OrderedDict()
+MEDIA_GROUPS = OrderedDict()
+CACHE_SIZE = 256
+
+
+def remember(cache: OrderedDict, key, payload):
+    cache[key] = payload
+    if len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def send_cached(client, message, cache, key, resolve, send):
+    """Send what is cached for key, resolving it once more if sending fails"""
+    payload = cache.get(key)
+    if payload is not None:
+        cache.move_to_end(key)
+        try:
+            return await send(client, message, payload)
+        except errors.FloodWait:
+            raise
+        except errors.RPCError:
+            # cached file ids may have expired
+            del cache[key]
+
+    payload = await resolve(client, *key)
+    remember(cache, key, payload)
+    return await send(client, message, payload)
+
+
+# noinspection PyTypeChecker
+@Client.on_message(contains)
+async def filters_main_handler(client: Client, message: Message):
+    value = get_filter(message.chat.id, message.filter_trigger)
+    if value is None or not limiter.allow("filters", message.chat.id):
+        raise ContinuePropagation
+
+    key = int(value["CHAT_ID"]), int(value["MESSAGE_ID"])
+    try:
+        if value.get("MEDIA_GROUP"):
+            await send_cached(
+                client,
+                message,
+                MEDIA_GROUPS,
+                key,
+                resolve_media_group,
+                send_media_group,
+            )
+        else:
+            await send_cached(client, message, REPLIES, key, resolve_reply, send_reply)
+    except errors.RPCError as exc:
+        raise ContinuePropagation from exc
     raise ContinuePropagation
 
 
@@ -132,11 +266,16 @@ async def filter_handler(client: Client, message: Message):
     try:
         if len(message.text.split()) < 2:
             return await message.edit(
-                f"<b>Usage</b>: <code>{prefix}filter [name] (Reply required)</code>"
+                f"<b>Usage</b>: <code>{prefix}filter [-w|-p|-c|-r] [name]"
+                " (Reply required)</code>"
             )
-        name = message.text.split(maxsplit=1)[1].lower()
-        chat_filters = get_filters_chat(message.chat.id)
-        if name in chat_filters.keys():
+        name, type_ = parse_trigger(message.text.split(maxsplit=1)[1])
+        if type_ == REGEX:
+            try:
+                re.compile(name)
+            except re.error as e:
+                return await message.edit(f"<b>Invalid regex</b>: <code>{e}</code>")
+        if get_filter(message.chat.id, name) is not None:
             return await message.edit(
                 f"<b>Filter</b> <code>{name}</code> already exists."
             )
@@ -174,6 +313,7 @@ async def filter_handler(client: Client, message: Message):
                 "MESSAGE_ID": str(message_id[1].id),
                 "MEDIA_GROUP": True,
                 "CHAT_ID": str(chat_id),
+                "TYPE": type_,
             }
         else:
             try:
@@ -184,11 +324,10 @@ async def filter_handler(client: Client, message: Message):
                 "MEDIA_GROUP": False,
                 "MESSAGE_ID": str(message_id.id),
                 "CHAT_ID": str(chat_id),
+                "TYPE": type_,
             }
 
-        chat_filters.update({name: filter_})
-
-        set_filters_chat(message.chat.id, chat_filters)
+        set_filter(message.chat.id, name, filter_)
         return await message.edit(
             f"<b>Filter</b> <code>{name}</code> has been added.",
         )
@@ -200,10 +339,14 @@ async def filter_handler(client: Client, message: Message):
 async def filters_handler(_, message: Message):
     try:
         text = ""
-        for index, a in enumerate(get_filters_chat(message.chat.id).items(), start=1):
-            key, _ = a
+        triggers = await get_triggers(message.chat.id)
+        for index, key in enumerate(
+            db.list_vars(f"core.filters.{message.chat.id}"), start=1
+        ):
+            type_ = triggers.type_of(key)
             key = key.replace("<", "").replace(">", "")
-            text += f"{index}. <code>{key}</code>\n"
+            suffix = f" ({type_})" if type_ not in (EXACT, None) else ""
+            text += f"{index}. <code>{key}</code>{suffix}\n"
         text = f"<b>Your filters in current chat</b>:\n\n" f"{text}"
         text = text[:4096]
         return await message.edit(text)
@@ -220,14 +363,12 @@ async def filter_del_handler(_, message: Message):
             return await message.edit(
                 f"<b>Usage</b>: <code>{prefix}fdel [name]</code>",
             )
-        name = message.text.split(maxsplit=1)[1].lower()
-        chat_filters = get_filters_chat(message.chat.id)
-        if name not in chat_filters.keys():
+        name, filter_ = find_filter(message.chat.id, message.text.split(maxsplit=1)[1])
+        if filter_ is None:
             return await message.edit(
                 f"<b>Filter</b> <code>{name}</code> doesn't exists.",
             )
-        del chat_filters[name]
-        set_filters_chat(message.chat.id, chat_filters)
+        remove_filter(message.chat.id, name)
         return await message.edit(
             f"<b>Filter</b> <code>{name}</code> has been deleted.",
         )
@@ -242,22 +383,24 @@ async def filter_search_handler(_, message: Message):
             return await message.edit(
                 f"<b>Usage</b>: <code>{prefix}fsearch [name]</code>",
             )
-        name = message.text.split(maxsplit=1)[1].lower()
-        chat_filters = get_filters_chat(message.chat.id)
-        if name not in chat_filters.keys():
+        name, filter_ = find_filter(message.chat.id, message.text.split(maxsplit=1)[1])
+        if filter_ is None:
             return await message.edit(
                 f"<b>Filter</b> <code>{name}</code> doesn't exists.",
             )
         return await message.edit(
-            f"<b>Trigger</b>:\n<code>{name}</code"
-            f">\n<b>Answer</b>:\n{chat_filters[name]}"
+            f"<b>Trigger</b>:\n<code>{name}</code>\n<b>Answer</b>:\n{filter_}"
         )
     except Exception as e:
         return await message.edit(format_exc(e))
 
 
 modules_help["filters"] = {
-    "filter [name]": "Create filter (Reply required)",
+    "filter [name]": "Create filter for messages equal to name (Reply required)",
+    "filter -w [word]": "Create filter for messages containing the word",
+    "filter -p [text]": "Create filter for messages starting with text",
+    "filter -c [text]": "Create filter for messages containing text anywhere",
+    "filter -r [regex]": "Create filter for messages matching a regex",
     "filters": "List of all triggers",
     "fdel [name]": "Delete filter by name",
     "fsearch [name]": "Info filter by name",
@@ -14,6 +14,8 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import math
+
 from pyrogram import Client, errors, filters
 from pyrogram.types import Message
 
@@ -21,6 +23,8 @@ from utils.db import db
 from utils.handlers import NoteSendHandler
 from utils.misc import modules_help, prefix
 
+NOTES_PER_PAGE = 50
+
 
 @Client.on_message(filters.command(["save"], prefix) & filters.me)
 async def save_note(client: Client, message: Message):
@@ -40,7 +44,7 @@ async def save_note(client: Client, message: Message):
     if message.reply_to_message and len(message.text.split()) >= 2:
         note_name = message.text.split(maxsplit=1)[1]
         if message.reply_to_message.media_group_id:
-            checking_note = db.get("core.notes", f"note{note_name}", False)
+            checking_note = db.get("core.notes.list", note_name, False)
             if not checking_note:
                 get_media_group = [
                     _.id
@@ -62,12 +66,12 @@ async def save_note(client: Client, message: Message):
                     "MEDIA_GROUP": True,
                     "CHAT_ID": str(chat_id),
                 }
-                db.set("core.notes", f"note{note_name}", note)
+                db.set("core.notes.list", note_name, note)
                 await message.edit(f"<b>Note {note_name} saved</b>")
             else:
                 await message.edit("<b>This note already exists</b>")
         else:
-            checking_note = db.get("core.notes", f"note{note_name}", False)
+            checking_note = db.get("core.notes.list", note_name, False)
             if not checking_note:
                 try:
                     message_id = await message.reply_to_message.forward(chat_id)
@@ -78,13 +82,13 @@ async def save_note(client: Client, message: Message):
                     "MESSAGE_ID": str(message_id.id),
                     "CHAT_ID": str(chat_id),
                 }
-                db.set("core.notes", f"note{note_name}", note)
+                db.set("core.notes.list", note_name, note)
                 await message.edit(f"<b>Note {note_name} saved</b>")
             else:
                 await message.edit("<b>This note already exists</b>")
     elif len(message.text.split()) >= 3:
         note_name = message.text.split(maxsplit=1)[1].split()[0]
-        checking_note = db.get("core.notes", f"note{note_name}", False)
+        checking_note = db.get("core.notes.list", note_name, False)
         if not checking_note:
             message_id = await client.send_message(
                 chat_id, message.text.split(note_name)[1].strip()
@@ -94,7 +98,7 @@ async def save_note(client: Client, message: Message):
                 "MESSAGE_ID": str(message_id.id),
                 "CHAT_ID": str(chat_id),
             }
-            db.set("core.notes", f"note{note_name}", note)
+            db.set("core.notes.list", note_name, note)
             await message.edit(f"<b>Note {note_name} saved</b>")
         else:
             await message.edit("<b>This note already exists</b>")
@@ -113,11 +117,21 @@ async def note_send(client: Client, message: Message):
 @Client.on_message(filters.command(["notes"], prefix) & filters.me)
 async def notes(_, message: Message):
     await message.edit("<b>Loading...</b>")
+    page = 1
+    if len(message.command) > 1 and message.command[1].isdigit():
+        page = max(int(message.command[1]), 1)
+
+    total_pages = math.ceil(db.count("core.notes.list") / NOTES_PER_PAGE) or 1
     text = "Available notes:\n\n"
-    collection = db.get_collection("core.notes")
-    for note in collection.keys():
-        if note[:4] == "note":
-            text += f"<code>{note[4:]}</code>\n"
+    for note in db.list_vars(
+        "core.notes.list", (page - 1) * NOTES_PER_PAGE, NOTES_PER_PAGE
+    ):
+        text += f"<code>{note}</code>\n"
+    if total_pages > 1:
+        text += (
+            f"\nPage {page}/{total_pages}, "
+            f"next: <code>{prefix}notes {min(page + 1, total_pages)}</code>"
+        )
     await message.edit(text)
 
 
@@ -125,9 +139,9 @@ async def notes(_, message: Message):
 async def clear_note(_, message: Message):
     if len(message.text.split()) >= 2:
         note_name = message.text.split(maxsplit=1)[1]
-        find_note = db.get("core.notes", f"note{note_name}", False)
+        find_note = db.get("core.notes.list", note_name, False)
         if find_note:
-            db.remove("core.notes", f"note{note_name}")
+            db.remove("core.notes.list", note_name)
             await message.edit(f"<b>Note {note_name} deleted</b>")
         else:
             await message.edit("<b>There is no such note</b>")
@@ -138,6 +152,6 @@ async def clear_note(_, message: Message):
 modules_help["notes"] = {
     "save [name]*": "Save note",
     "note [name]*": "Get saved note",
-    "notes": "Get note list",
+    "notes [page]": "Get note list",
     "clear [name]*": "Delete note",
 }
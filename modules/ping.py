@@ -14,6 +14,9 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+# meta lazy: no
+# uptime is counted from import
+
 import datetime
 from time import perf_counter
 
@@ -0,0 +1,102 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pyrogram import Client, filters
+from pyrogram.types import Message
+
+from utils.misc import modules_help, prefix
+from utils.ratelimit import limiter
+
+LIMITED_MODULES = ("filters", "afk", "antipm")
+
+
+def format_limits(rate, burst) -> str:
+    if rate <= 0:
+        return "no limit"
+    return f"{rate:g}/min, burst {burst}"
+
+
+def ratelimit_stats() -> str:
+    rate, burst = limiter.default
+    lines = [f"<b>Default:</b> <code>{format_limits(rate, burst)}</code>"]
+    for key, (rate, burst) in sorted(limiter.overrides.items()):
+        lines.append(f"<b>{key}:</b> <code>{format_limits(rate, burst)}</code>")
+
+    stats = limiter.stats()
+    if not stats:
+        return "\n".join(lines) + "\n\n<i>No automatic replies yet</i>"
+
+    lines.append("\n<b>Replies sent / suppressed:</b>")
+    for module, (sent, suppressed) in stats.items():
+        lines.append(f"<code>{module}</code>: {sent} / {suppressed}")
+
+    noisiest = limiter.noisiest()
+    if noisiest:
+        lines.append("\n<b>Most suppressed chats:</b>")
+        for (module, chat_id), count in noisiest:
+            lines.append(f"<code>{chat_id}</code> ({module}): {count}")
+    return "\n".join(lines)
+
+
+@Client.on_message(filters.command(["ratelimit", "rl"], prefix) & filters.me)
+async def ratelimit(_, message: Message):
+    args = message.command[1:]
+    if not args:
+        return await message.edit(ratelimit_stats())
+
+    if args[0] == "reset" and len(args) == 1:
+        limiter.reset_stats()
+        return await message.edit("<b>Rate limit counters reset</b>")
+
+    usage = (
+        f"<b>Usage:</b> <code>{prefix}ratelimit [set|here] "
+        f"[{'|'.join(LIMITED_MODULES)}] [per_minute] [burst]</code>"
+    )
+    if args[0] not in ("set", "here") or len(args) < 2:
+        return await message.edit(usage)
+    if args[1] not in LIMITED_MODULES:
+        return await message.edit(usage)
+
+    module = args[1]
+    chat_id = message.chat.id if args[0] == "here" else None
+    where = "this chat" if chat_id is not None else "all chats"
+    if len(args) == 2:
+        limiter.set_limits(module, chat_id)
+        rate, burst = limiter.limits(module, chat_id)
+        return await message.edit(
+            f"<b>{module} in {where}:</b> <code>{format_limits(rate, burst)}</code>"
+        )
+
+    try:
+        rate = float(args[2])
+        burst = int(args[3]) if len(args) > 3 else max(1, int(rate))
+    except ValueError:
+        return await message.edit(usage)
+    if rate < 0 or burst < 1:
+        return await message.edit(usage)
+
+    limiter.set_limits(module, chat_id, rate, burst)
+    await message.edit(
+        f"<b>{module} in {where}:</b> <code>{format_limits(rate, burst)}</code>"
+    )
+
+
+modules_help["ratelimit"] = {
+    "ratelimit": "Limits and sent / suppressed automatic replies of filters, afk and antipm",
+    "ratelimit set [module] [per_minute] [burst]": "Limit a module's replies in every chat, 0 per minute for no limit. Without numbers, go back to the default",
+    "ratelimit here [module] [per_minute] [burst]": "Limit a module's replies in the current chat. Without numbers, go back to the module's limit",
+    "ratelimit reset": "Reset the counters",
+}
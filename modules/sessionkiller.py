@@ -27,7 +27,7 @@ from pyrogram.raw.functions.account import GetAuthorizations, ResetAuthorization
 from pyrogram.raw.types import UpdateServiceNotification
 from pyrogram.types import Message
 
-from utils.db import db
+from utils.db import db, adb
 from utils.misc import modules_help, prefix
 
 auth_hashes = db.get("core.sessionkiller", "auths_hashes", [])
@@ -100,7 +100,7 @@ async def check_new_login(client: Client, update: UpdateServiceNotification, _,
         "auth"
     ):
         raise ContinuePropagation
-    if not db.get("core.sessionkiller", "enabled", False):
+    if not await adb.aget("core.sessionkiller", "enabled", False):
         raise ContinuePropagation
     authorizations = (await client.invoke(GetAuthorizations()))["authorizations"]
     for auth in authorizations:
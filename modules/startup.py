@@ -0,0 +1,65 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+from html import escape
+
+from pyrogram import Client, filters
+from pyrogram.types import Message
+
+from utils.db import db
+from utils.misc import modules_help, prefix
+from utils.startup import PROFILE_FLAG, format_run
+
+
+@Client.on_message(filters.command(["startup"], prefix) & filters.me)
+async def startup(_, message: Message):
+    runs = db.get("core.startup", "runs", [])
+    if not runs:
+        return await message.edit("<b>No startup recorded yet</b>")
+
+    if len(message.command) > 1 and message.command[1] == "history":
+        lines = [
+            f"{datetime.datetime.fromtimestamp(run['time']):%Y-%m-%d %H:%M}  "
+            f"{run['total']:.2f}s"
+            for run in runs
+        ]
+        return await message.edit(
+            "<b>Last startups:</b>\n<code>" + "\n".join(lines) + "</code>"
+        )
+
+    try:
+        index = int(message.command[1]) if len(message.command) > 1 else 0
+        run = runs[index]
+    except (ValueError, IndexError):
+        return await message.edit(
+            f"<b>Usage:</b> <code>{prefix}startup [0-{len(runs) - 1}|history]</code>"
+        )
+
+    previous = runs[index + 1] if index + 1 < len(runs) else None
+    text = f"<pre>{escape(format_run(run, previous))}</pre>"
+    if not run["imports"]:
+        text += (
+            "\n<i>Start with</i> <code>python main.py "
+            f"{PROFILE_FLAG}</code> <i>to time every import</i>"
+        )
+    await message.edit(text)
+
+
+modules_help["startup"] = {
+    "startup [n]": "Startup timeline and slowest modules, n runs ago (0 is the last one)",
+    "startup history": "Duration of the last startups",
+}
@@ -19,7 +19,7 @@ from pyrogram.types import Message
 import random
 import datetime
 
-from utils.misc import modules_help, prefix, userbot_version, python_version, gitrepo
+from utils.misc import modules_help, prefix, userbot_version, python_version
 
 
 @Client.on_message(filters.command(["support", "repo"], prefix) & filters.me)
@@ -59,6 +59,8 @@ async def version(client: Client, message: Message):
 
     await message.delete()
 
+    from utils.misc import gitrepo
+
     remote_url = list(gitrepo.remote().urls)[0]
     commit_time = (
         datetime.datetime.fromtimestamp(gitrepo.head.commit.committed_date)
@@ -22,7 +22,7 @@ import subprocess
 from pyrogram import Client, filters
 from pyrogram.types import Message
 
-from utils.misc import modules_help, prefix, requirements_list
+from utils.misc import modules_help, prefix, requirements_list, write_version_info
 from utils.db import db
 from utils.scripts import format_exc, restart
 
@@ -101,6 +101,7 @@ async def update(_, message: Message):
                 [sys.executable, "-m", "pip", "install", "-U", *requirements_list],
                 check=True,
             )
+        write_version_info()
     except Exception as e:
         await message.edit(format_exc(e))
         db.remove("core.updater", "restart_info")
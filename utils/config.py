@@ -7,6 +7,12 @@ try:
 except FileNotFoundError:
     print("No .env file found, using os.environ.")
 
+
+def _flag(value) -> bool:
+    # os.getenv() gives strings, so bool() would read "False" as True
+    return str(value).strip().lower() in ("true", "1", "yes", "on")
+
+
 api_id = int(os.getenv("API_ID", env.int("API_ID")))
 api_hash = os.getenv("API_HASH", env.str("API_HASH"))
 
@@ -17,6 +23,25 @@ second_session = os.getenv("SECOND_SESSION", env.str("SECOND_SESSION", ""))
 db_type = os.getenv("DATABASE_TYPE", env.str("DATABASE_TYPE"))
 db_url = os.getenv("DATABASE_URL", env.str("DATABASE_URL", ""))
 db_name = os.getenv("DATABASE_NAME", env.str("DATABASE_NAME"))
+db_cache_size = int(
+    os.getenv("DATABASE_CACHE_SIZE", env.int("DATABASE_CACHE_SIZE", 4096))
+)
+db_pool_size = int(os.getenv("DATABASE_POOL_SIZE", env.int("DATABASE_POOL_SIZE", 20)))
+db_timeout_ms = int(
+    os.getenv("DATABASE_TIMEOUT_MS", env.int("DATABASE_TIMEOUT_MS", 10000))
+)
+db_nameserver = os.getenv("DNS_NAMESERVER", env.str("DNS_NAMESERVER", "1.1.1.1"))
+db_commit_interval = float(
+    os.getenv("DATABASE_COMMIT_INTERVAL", env.float("DATABASE_COMMIT_INTERVAL", 0.5))
+)
+db_commit_every = int(
+    os.getenv("DATABASE_COMMIT_EVERY", env.int("DATABASE_COMMIT_EVERY", 100))
+)
+db_busy_timeout = float(
+    os.getenv("DATABASE_BUSY_TIMEOUT", env.float("DATABASE_BUSY_TIMEOUT", 30))
+)
+# other processes write to the same database, so caches must notice their writes
+db_shared = _flag(os.getenv("DATABASE_SHARED", env.bool("DATABASE_SHARED", False)))
 
 apiflash_key = os.getenv("APIFLASH_KEY", env.str("APIFLASH_KEY"))
 rmbg_key = os.getenv("RMBG_KEY", env.str("RMBG_KEY", ""))
@@ -25,8 +50,19 @@ gemini_key = os.getenv("GEMINI_KEY", env.str("GEMINI_KEY", ""))
 cohere_key = os.getenv("COHERE_KEY", env.str("COHERE_KEY", ""))
 
 pm_limit = int(os.getenv("PM_LIMIT", env.int("PM_LIMIT", 4)))
+# automatic replies (filters, afk, antipm) per chat
+ratelimit_rate = float(
+    os.getenv("RATE_LIMIT_PER_MINUTE", env.float("RATE_LIMIT_PER_MINUTE", 6.0))
+)
+ratelimit_burst = int(os.getenv("RATE_LIMIT_BURST", env.int("RATE_LIMIT_BURST", 3)))
 
 test_server = bool(os.getenv("TEST_SERVER", env.bool("TEST_SERVER", False)))
+lazy_modules = _flag(os.getenv("LAZY_MODULES", env.bool("LAZY_MODULES", False)))
+command_router = _flag(os.getenv("COMMAND_ROUTER", env.bool("COMMAND_ROUTER", True)))
+hot_reload = _flag(os.getenv("HOT_RELOAD", env.bool("HOT_RELOAD", False)))
+hot_reload_interval = float(
+    os.getenv("HOT_RELOAD_INTERVAL", env.float("HOT_RELOAD_INTERVAL", 1.0))
+)
 modules_repo_branch = os.getenv(
     "MODULES_REPO_BRANCH", env.str("MODULES_REPO_BRANCH", "master")
 )
@@ -16,14 +16,40 @@
 
 import re
 import json
+import atexit
+import logging
+import asyncio
 import threading
 import sqlite3
-from dns import resolver
+import time
+from copy import deepcopy
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
 from utils import config
 
-resolver.default_resolver = resolver.Resolver(configure=False)
-resolver.default_resolver.nameservers = ["1.1.1.1"]
+MODULE_NAME = re.compile(r"^(core|custom)")
+LOCK_RETRIES = 5
+
+
+def estimate_tokens(message) -> int:
+    """Rough token count of a chat history entry (~4 characters per token)"""
+    text = message.get("message", "") if isinstance(message, dict) else message
+    return len(str(text)) // 4 + 1
+
+
+def _take_recent(messages, max_tokens=None) -> list:
+    """Collect newest-first messages until the token budget runs out"""
+    recent = []
+    for message in messages:
+        if max_tokens is not None:
+            max_tokens -= estimate_tokens(message)
+            if max_tokens < 0:
+                break
+        recent.append(message)
+    recent.reverse()
+    return recent
 
 
 class Database:
@@ -43,195 +69,1045 @@ class Database:
         """Get database for selected module"""
         raise NotImplementedError
 
+    def list_modules(self) -> list:
+        """Get names of all core.* and custom.* modules"""
+        raise NotImplementedError
+
+    def iter_collection(self, module: str):
+        """Iterate over (key, value) pairs of selected module"""
+        yield from self.get_collection(module).items()
+
+    def iter_chat_history(self):
+        """Iterate over (user_id, message) pairs of every stored chat history"""
+        raise NotImplementedError
+
+    def list_vars(self, module: str, offset: int = 0, limit: int = None) -> list:
+        """Get sorted keys of selected module, optionally one page of them"""
+        keys = sorted(self.get_collection(module))
+        return keys[offset:] if limit is None else keys[offset : offset + limit]
+
+    def count(self, module: str) -> int:
+        """Get number of keys in selected module"""
+        return len(self.get_collection(module))
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        """Get several values of a module at once"""
+        return {variable: self.get(module, variable, default) for variable in variables}
+
+    def set_many(self, module: str, values: dict):
+        """Set several keys of a module at once"""
+        for variable, value in values.items():
+            self.set(module, variable, value)
+
     def close(self):
         """Close the database"""
         raise NotImplementedError
 
+    def flush(self):
+        """Write pending changes to disk"""
+
+    def changed_elsewhere(self) -> bool:
+        """Check if another process changed the database since the last call"""
+        return False
+
+    def share(self):
+        """Expect other processes to write to the database from now on"""
+
+    def add_chat_history(self, user_id, message, limit: int = None):
+        """Append message to user's chat history, keeping at most `limit` last ones"""
+        chat_history = self.get(f"core.cohere.user_{user_id}", "chat_history", [])
+        chat_history.append(message)
+        if limit:
+            chat_history = chat_history[-limit:]
+        self.set(f"core.cohere.user_{user_id}", "chat_history", chat_history)
+
+    def clear_chat_history(self, user_id):
+        """Delete user's chat history"""
+        self.remove(f"core.cohere.user_{user_id}", "chat_history")
+
+    def get_chat_history(
+        self, user_id, default=None, limit: int = None, max_tokens: int = None
+    ):
+        """Get last `limit` messages of user's chat history that fit in `max_tokens`"""
+        chat_history = self.get(f"core.cohere.user_{user_id}", "chat_history")
+        if not chat_history:
+            return [] if default is None else default
+        return _take_recent(islice(reversed(chat_history), limit), max_tokens)
+
+    def addaiuser(self, user_id):
+        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
+        if user_id not in chatai_users:
+            chatai_users.append(user_id)
+            self.set("core.chatbot", "chatai_users", chatai_users)
+
+    def remaiuser(self, user_id):
+        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
+        if user_id in chatai_users:
+            chatai_users.remove(user_id)
+            self.set("core.chatbot", "chatai_users", chatai_users)
+
+    def getaiusers(self):
+        return self.get("core.chatbot", "chatai_users", default=[])
+
 
 class MongoDatabase(Database):
-    def __init__(self, url, name):
-        self._client = pymongo.MongoClient(url)
+    def __init__(
+        self,
+        url,
+        name,
+        pool_size: int = 20,
+        timeout_ms: int = 10000,
+        nameserver: str = None,
+        client=None,
+        shared: bool = False,
+    ):
+        if client is None:
+            if nameserver and url.startswith("mongodb+srv"):
+                # SRV records are resolved through dnspython, which doesn't
+                # work with the system resolver on some hosts (e.g. Termux)
+                from dns import resolver
+
+                resolver.default_resolver = resolver.Resolver(configure=False)
+                resolver.default_resolver.nameservers = [nameserver]
+            client = pymongo.MongoClient(
+                url,
+                maxPoolSize=pool_size,
+                connectTimeoutMS=timeout_ms,
+                serverSelectionTimeoutMS=timeout_ms,
+                socketTimeoutMS=timeout_ms,
+            )
+        self._client = client
         self._database = self._client[name]
+        self._history = self._database["chat_history"]
+        self._history_users = set()
+        self._indexed = set()
+        # while other processes use the database, every write bumps a shared
+        # counter; a jump bigger than our own writes means another one wrote
+        self._versions = self._database["db_version"]
+        self._version = 0
+        self._own_writes = 0
+        self._version_lock = threading.Lock()
+        self._shared = False
+        if shared:
+            self.share()
+
+    def _read_version(self) -> int:
+        doc = self._versions.find_one({"_id": "writes"})
+        return 0 if doc is None else doc["n"]
+
+    def share(self):
+        with self._version_lock:
+            if self._shared:
+                return
+            self._version = self._read_version()
+            self._own_writes = 0
+            self._shared = True
+
+    def _wrote(self):
+        # a single process doesn't pay an extra round-trip per write
+        if not self._shared:
+            return
+        self._versions.update_one({"_id": "writes"}, {"$inc": {"n": 1}}, upsert=True)
+        with self._version_lock:
+            self._own_writes += 1
+
+    def changed_elsewhere(self) -> bool:
+        if not self._shared:
+            return False
+        version = self._read_version()
+        with self._version_lock:
+            changed = version - self._version != self._own_writes
+            self._version = version
+            self._own_writes = 0
+        return changed
+
+    def _collection(self, module: str, create: bool = True):
+        """The module's collection, reads pass create=False to not make it exist"""
+        collection = self._database[module]
+        if create and module not in self._indexed:
+            try:
+                collection.create_index("var", unique=True)
+            except pymongo.errors.OperationFailure:
+                # duplicates left over from before the index existed
+                collection.create_index("var")
+            self._indexed.add(module)
+        return collection
 
     def set(self, module: str, variable: str, value):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        self._database[module].replace_one(
+        self._collection(module).replace_one(
             {"var": variable}, {"var": variable, "val": value}, upsert=True
         )
+        self._wrote()
 
     def get(self, module: str, variable: str, default=None):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        doc = self._database[module].find_one({"var": variable})
+        doc = self._collection(module, False).find_one({"var": variable})
         return default if doc is None else doc["val"]
 
     def get_collection(self, module: str):
         if not isinstance(module, str):
             raise ValueError("Module must be a string")
-        return {item["var"]: item["val"] for item in self._database[module].find()}
+        collection = self._collection(module, False)
+        return {item["var"]: item["val"] for item in collection.find()}
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        variables = list(variables)
+        collection = self._collection(module, False)
+        found = {
+            item["var"]: item["val"]
+            for item in collection.find({"var": {"$in": variables}})
+        }
+        return {variable: found.get(variable, default) for variable in variables}
+
+    def set_many(self, module: str, values: dict):
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        if not values:
+            return
+        self._collection(module).bulk_write(
+            [
+                pymongo.ReplaceOne(
+                    {"var": variable}, {"var": variable, "val": value}, upsert=True
+                )
+                for variable, value in values.items()
+            ]
+        )
+        self._wrote()
 
     def remove(self, module: str, variable: str):
         if not isinstance(module, str) or not isinstance(variable, str):
             raise ValueError("Module and variable must be strings")
-        self._database[module].delete_one({"var": variable})
+        self._collection(module, False).delete_one({"var": variable})
+        self._wrote()
+
+    def list_modules(self) -> list:
+        return sorted(
+            name
+            for name in self._database.list_collection_names()
+            if MODULE_NAME.match(name)
+        )
+
+    def iter_collection(self, module: str):
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        for item in self._collection(module, False).find().batch_size(500):
+            yield item["var"], item["val"]
+
+    def iter_chat_history(self):
+        for doc in self._history.find().batch_size(50):
+            for message in doc["messages"]:
+                yield doc["user_id"], message
+
+    def list_vars(self, module: str, offset: int = 0, limit: int = None) -> list:
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        collection = self._collection(module, False)
+        cursor = collection.find({}, {"var": 1}).sort("var").skip(offset)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return [item["var"] for item in cursor]
+
+    def count(self, module: str) -> int:
+        if not isinstance(module, str):
+            raise ValueError("Module must be a string")
+        return self._collection(module, False).count_documents({})
 
     def close(self):
         self._client.close()
 
-    def add_chat_history(self, user_id, message):
-        chat_history = self.get_chat_history(user_id, default=[])
-        chat_history.append(message)
-        self.set(f"core.cohere.user_{user_id}", "chat_history", chat_history)
+    def _prepare_history(self, user_id):
+        if user_id in self._history_users:
+            return
+        if not self._history_users:
+            self._history.create_index("user_id", unique=True)
+        self._history_users.add(user_id)
 
-    def get_chat_history(self, user_id, default=None):
-        if default is None:
-            default = []
-        return self.get(f"core.cohere.user_{user_id}", "chat_history", default=[])
+        # move the history out of the old one-document-per-user layout
+        legacy = self._database[f"core.cohere.user_{user_id}"]
+        doc = legacy.find_one({"var": "chat_history"})
+        if doc and doc["val"]:
+            self._history.update_one(
+                {"user_id": user_id},
+                {"$push": {"messages": {"$each": doc["val"], "$position": 0}}},
+                upsert=True,
+            )
+            legacy.delete_one({"var": "chat_history"})
 
-    def addaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id not in chatai_users:
-            chatai_users.append(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    def add_chat_history(self, user_id, message, limit: int = None):
+        self._prepare_history(user_id)
+        push = {"$each": [message]}
+        if limit:
+            push["$slice"] = -limit
+        self._history.update_one(
+            {"user_id": user_id}, {"$push": {"messages": push}}, upsert=True
+        )
 
-    def remaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id in chatai_users:
-            chatai_users.remove(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    def clear_chat_history(self, user_id):
+        self._prepare_history(user_id)
+        self._history.delete_one({"user_id": user_id})
 
-    def getaiusers(self):
-        return self.get("core.chatbot", "chatai_users", default=[])
+    def get_chat_history(
+        self, user_id, default=None, limit: int = None, max_tokens: int = None
+    ):
+        self._prepare_history(user_id)
+        projection = {"messages": {"$slice": -limit}} if limit else None
+        doc = self._history.find_one({"user_id": user_id}, projection)
+        if not doc or not doc["messages"]:
+            return [] if default is None else default
+        return _take_recent(reversed(doc["messages"]), max_tokens)
 
 
 class SqliteDatabase(Database):
-    def __init__(self, file):
-        self._conn = sqlite3.connect(file, check_same_thread=False)
+    def __init__(
+        self,
+        file,
+        wal: bool = True,
+        commit_interval: float = 0.0,
+        commit_every: int = 1,
+        busy_timeout: float = 30.0,
+    ):
+        # several processes (e.g. main and second session) may share the file,
+        # so wait for their locks instead of failing right away
+        self._conn = sqlite3.connect(
+            file, timeout=busy_timeout, check_same_thread=False
+        )
         self._conn.row_factory = sqlite3.Row
+        if wal:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
         self._cursor = self._conn.cursor()
         self._lock = threading.Lock()
 
+        # tables known to exist, so the hot path never has to look them up
+        self._tables = self._list_tables()
+
+        self._history_users = set()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+        # write queue: writes wait here and are applied in one short
+        # transaction every `commit_every` writes or `commit_interval` seconds
+        # after the first queued one, so the file is never write-locked while
+        # this process waits, and other processes aren't kept waiting
+        self._commit_interval = commit_interval
+        self._commit_every = max(commit_every, 1)
+        self._queue = []
+        # (module, var) -> (val, type), or None if removed, for reads
+        self._queued = {}
+        # modules (and "chat_history") with queued writes
+        self._queued_modules = set()
+        self._pending = 0
+        self._timer = None
+        self._closed = False
+        atexit.register(self.flush)
+
+    def _list_tables(self) -> set:
+        return {
+            row["name"]
+            for row in self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+        }
+
     @staticmethod
-    def _parse_row(row: sqlite3.Row):
-        if row["type"] == "bool":
-            return row["val"] == "1"
-        if row["type"] == "int":
-            return int(row["val"])
-        if row["type"] == "str":
-            return row["val"]
-        return json.loads(row["val"])
-
-    def _execute(self, module: str, *args, **kwargs) -> sqlite3.Cursor:
-        pattern = r"^(core|custom)"
-        if not re.match(pattern, module):
-            raise ValueError(f"Invalid module name format: {module}")
+    def _retry_locked(func, *args):
+        # the busy timeout has already expired here, back off a bit more;
+        # the caller holds self._lock, so this process' writes queue up behind
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == LOCK_RETRIES - 1:
+                    raise
+                time.sleep(0.1 * 2**attempt)
 
-        self._lock.acquire()
+    def _apply_queue(self):
+        """Write every queued change in one transaction"""
         try:
+            for operation, *args in self._queue:
+                if operation == "set":
+                    module, rows = args
+                    self._ensure_table(module)
+                    self._conn.executemany(
+                        self._upsert_sql(module),
+                        [(var, val, typ, val, typ, var) for var, val, typ in rows],
+                    )
+                elif operation == "remove":
+                    module, variable = args
+                    if self._has_table(module):
+                        self._conn.execute(
+                            f"DELETE FROM '{module}' WHERE var=?", (variable,)
+                        )
+                elif operation == "add_history":
+                    self._insert_history(*args)
+                elif operation == "clear_history":
+                    self._prepare_history(*args)
+                    self._conn.execute("DELETE FROM chat_history WHERE user_id=?", args)
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            # forget tables and migrations that were rolled back
+            self._tables = self._list_tables()
+            self._history_users.clear()
+            raise
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._queue:
+            self._retry_locked(self._apply_queue)
+        self._queue.clear()
+        self._queued.clear()
+        self._queued_modules.clear()
+        self._pending = 0
+
+    def _enqueue(self, module: str, operation: tuple, count: int = 1, values=None):
+        with self._lock:
+            self._queue.append(operation)
+            if values:
+                self._queued.update(values)
+            self._queued_modules.add(module)
+            self._pending += count
+            if self._pending >= self._commit_every or self._commit_interval <= 0:
+                self._commit()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._commit_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._pending and not self._closed:
+                self._commit()
+
+    @staticmethod
+    def _decode(val: str, typ: str):
+        if typ == "bool":
+            return val == "1"
+        if typ == "int":
+            return int(val)
+        if typ == "str":
+            return val
+        return json.loads(val)
+
+    @classmethod
+    def _parse_row(cls, row: sqlite3.Row):
+        return cls._decode(row["val"], row["type"])
+
+    @staticmethod
+    def _check_module(module: str):
+        if not MODULE_NAME.match(module):
+            raise ValueError(f"Invalid module name format: {module}")
+
+    def _ensure_table(self, module: str):
+        if module in self._tables:
+            return
+        self._check_module(module)
+
+        sql = f"""
+        CREATE TABLE IF NOT EXISTS '{module}' (
+        var TEXT UNIQUE NOT NULL,
+        val TEXT NOT NULL,
+        type TEXT NOT NULL
+        )
+        """
+        self._conn.execute(sql)
+        self._tables.add(module)
+
+    def _has_table(self, module: str) -> bool:
+        # another process may have created it since we started
+        if module not in self._tables:
+            row = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (module,)
+            ).fetchone()
+            if row is None:
+                return False
+            self._tables.add(module)
+        return True
+
+    def _query(self, module: str, *args, flush=True) -> sqlite3.Cursor | None:
+        """
+        Run a read, None if the module has no table. Queued writes of the
+        module are committed first, unless the caller looks them up itself
+        """
+        with self._lock:
+            if flush and module in self._queued_modules:
+                self._commit()
+            if not self._retry_locked(self._has_table, module):
+                return None
             cursor = self._conn.cursor()
-            return cursor.execute(*args, **kwargs)
-        except sqlite3.OperationalError as e:
-            if str(e).startswith("no such table"):
-                sql = f"""
-                CREATE TABLE IF NOT EXISTS '{module}' (
-                var TEXT UNIQUE NOT NULL,
-                val TEXT NOT NULL,
-                type TEXT NOT NULL
-                )
-                """
-                cursor = self._conn.cursor()
-                cursor.execute(sql)
-                self._conn.commit()
-                return cursor.execute(*args, **kwargs)
-            raise e from None
-        finally:
-            self._lock.release()
+            return self._retry_locked(cursor.execute, *args)
+
+    def changed_elsewhere(self) -> bool:
+        with self._lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            changed = version != self._data_version
+            self._data_version = version
+        return changed
 
     def get(self, module: str, variable: str, default=None):
+        queued = self._queued.get((module, variable), False)
+        if queued is not False:
+            return default if queued is None else self._decode(*queued)
+
         sql = f"SELECT * FROM '{module}' WHERE var=?"
-        cur = self._execute(module, sql, (variable,))
+        cur = self._query(module, sql, (variable,), flush=False)
 
-        row = cur.fetchone()
+        row = None if cur is None else cur.fetchone()
         if row is None:
             return default
         return self._parse_row(row)
 
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bool):
+            return ("1" if value else "0"), "bool"
+        if isinstance(value, str):
+            return value, "str"
+        if isinstance(value, int):
+            return str(value), "int"
+        return json.dumps(value), "json"
+
     def set(self, module: str, variable: str, value) -> bool:
-        sql = f"""
+        self.set_many(module, {variable: value})
+        return True
+
+    @staticmethod
+    def _upsert_sql(module: str) -> str:
+        return f"""
         INSERT INTO '{module}' VALUES ( ?, ?, ? )
         ON CONFLICT (var) DO
         UPDATE SET val=?, type=? WHERE var=?
         """
 
-        if isinstance(value, bool):
-            val = "1" if value else "0"
-            typ = "bool"
-        elif isinstance(value, str):
-            val = value
-            typ = "str"
-        elif isinstance(value, int):
-            val = str(value)
-            typ = "int"
-        else:
-            val = json.dumps(value)
-            typ = "json"
-
-        self._execute(module, sql, (variable, val, typ, val, typ, variable))
-        self._conn.commit()
+    def get_many(self, module: str, variables, default=None) -> dict:
+        variables = list(variables)
+        found = {}
+        missing = []
+        for variable in variables:
+            queued = self._queued.get((module, variable), False)
+            if queued is False:
+                missing.append(variable)
+            elif queued is not None:
+                found[variable] = self._decode(*queued)
 
-        return True
+        if missing:
+            placeholders = ", ".join("?" * len(missing))
+            sql = f"SELECT * FROM '{module}' WHERE var IN ({placeholders})"
+            cur = self._query(module, sql, missing, flush=False)
+            found.update((row["var"], self._parse_row(row)) for row in cur or ())
+        return {variable: found.get(variable, default) for variable in variables}
+
+    def set_many(self, module: str, values: dict):
+        self._check_module(module)
+        rows = [(variable, *self._encode(value)) for variable, value in values.items()]
+        if not rows:
+            return
+        queued = {(module, variable): (val, typ) for variable, val, typ in rows}
+        self._enqueue(module, ("set", module, rows), len(rows), queued)
 
     def remove(self, module: str, variable: str):
-        sql = f"DELETE FROM '{module}' WHERE var=?"
-        self._execute(module, sql, (variable,))
-        self._conn.commit()
+        queued = {(module, variable): None}
+        self._enqueue(module, ("remove", module, variable), values=queued)
 
     def get_collection(self, module: str) -> dict:
-        pattern = r"^(core|custom)"
-        if not re.match(pattern, module):
-            raise ValueError(f"Invalid module name format: {module}")
-
         sql = f"SELECT * FROM '{module}'"
-        cur = self._execute(module, sql)
+        cur = self._query(module, sql)
 
         collection = {}
-        for row in cur:
+        for row in cur or ():
             collection[row["var"]] = self._parse_row(row)
 
         return collection
 
+    def list_modules(self) -> list:
+        with self._lock:
+            if self._queued_modules:
+                self._commit()
+            # include tables created by other processes
+            self._tables = self._list_tables()
+            return sorted(name for name in self._tables if MODULE_NAME.match(name))
+
+    def iter_collection(self, module: str, batch_size: int = 500):
+        # page through the var index so the lock isn't held between batches
+        sql = f"SELECT * FROM '{module}' WHERE var > ? ORDER BY var LIMIT ?"
+        last = ""
+        while True:
+            cur = self._query(module, sql, (last, batch_size))
+            rows = [] if cur is None else cur.fetchall()
+            for row in rows:
+                yield row["var"], self._parse_row(row)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]["var"]
+
+    def iter_chat_history(self, batch_size: int = 500):
+        last = 0
+        while True:
+            cur = self._query(
+                "chat_history",
+                "SELECT * FROM chat_history WHERE id > ? ORDER BY id LIMIT ?",
+                (last, batch_size),
+            )
+            rows = [] if cur is None else cur.fetchall()
+            for row in rows:
+                yield row["user_id"], json.loads(row["message"])
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]["id"]
+
+    def list_vars(self, module: str, offset: int = 0, limit: int = None) -> list:
+        sql = f"SELECT var FROM '{module}' ORDER BY var LIMIT ? OFFSET ?"
+        cur = self._query(module, sql, (-1 if limit is None else limit, offset))
+        return [row["var"] for row in cur or ()]
+
+    def count(self, module: str) -> int:
+        cur = self._query(module, f"SELECT COUNT(*) FROM '{module}'")
+        return 0 if cur is None else cur.fetchone()[0]
+
     def close(self):
-        self._conn.commit()
-        self._conn.close()
+        with self._lock:
+            self._commit()
+            self._closed = True
+            self._conn.close()
+        atexit.unregister(self.flush)
 
-    def add_chat_history(self, user_id, message):
-        chat_history = self.get_chat_history(user_id, default=[])
-        chat_history.append(message)
-        self.set(f"core.cohere.user_{user_id}", "chat_history", chat_history)
+    def _prepare_history(self, user_id) -> bool:
+        if "chat_history" not in self._tables:
+            sql = """
+            CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL
+            )
+            """
+            self._conn.execute(sql)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS chat_history_user "
+                "ON chat_history (user_id, id)"
+            )
+            self._tables.add("chat_history")
 
-    def get_chat_history(self, user_id, default=None):
-        if default is None:
-            default = []
-        return self.get(f"core.cohere.user_{user_id}", "chat_history", default=[])
+        if user_id in self._history_users:
+            return False
+        self._history_users.add(user_id)
 
-    def addaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id not in chatai_users:
-            chatai_users.append(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+        # move the history out of the old one-row-per-user layout
+        legacy = f"core.cohere.user_{user_id}"
+        if legacy not in self._tables:
+            return False
+        row = self._conn.execute(
+            f"SELECT * FROM '{legacy}' WHERE var='chat_history'"
+        ).fetchone()
+        if row is None:
+            return False
+        self._conn.executemany(
+            "INSERT INTO chat_history (user_id, message) VALUES (?, ?)",
+            [(user_id, json.dumps(message)) for message in self._parse_row(row)],
+        )
+        self._conn.execute(f"DELETE FROM '{legacy}' WHERE var='chat_history'")
+        return True
 
-    def remaiuser(self, user_id):
-        chatai_users = self.get("core.chatbot", "chatai_users", default=[])
-        if user_id in chatai_users:
-            chatai_users.remove(user_id)
-            self.set("core.chatbot", "chatai_users", chatai_users)
+    def _insert_history(self, user_id, message: str, limit: int = None):
+        self._prepare_history(user_id)
+        self._conn.execute(
+            "INSERT INTO chat_history (user_id, message) VALUES (?, ?)",
+            (user_id, message),
+        )
+        if limit:
+            self._conn.execute(
+                """
+                DELETE FROM chat_history WHERE user_id=? AND id <= (
+                SELECT id FROM chat_history WHERE user_id=?
+                ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (user_id, user_id, limit),
+            )
 
-    def getaiusers(self):
-        return self.get("core.chatbot", "chatai_users", default=[])
+    def add_chat_history(self, user_id, message, limit: int = None):
+        self._enqueue(
+            "chat_history", ("add_history", user_id, json.dumps(message), limit)
+        )
+
+    def clear_chat_history(self, user_id):
+        self._enqueue("chat_history", ("clear_history", user_id))
+
+    def get_chat_history(
+        self, user_id, default=None, limit: int = None, max_tokens: int = None
+    ):
+        with self._lock:
+            if "chat_history" in self._queued_modules:
+                self._commit()
+            migrated = self._prepare_history(user_id)
+            if migrated:
+                self._retry_locked(self._conn.commit)
+            cur = self._conn.execute(
+                "SELECT message FROM chat_history WHERE user_id=? "
+                "ORDER BY id DESC LIMIT ?",
+                (user_id, -1 if limit is None else limit),
+            )
+            chat_history = _take_recent(
+                (json.loads(row["message"]) for row in cur), max_tokens
+            )
+
+        if not chat_history:
+            return [] if default is None else default
+        return chat_history
+
+
+_ABSENT = object()
+NOT_CACHED = object()
+
+
+class LatencyStats:
+    """Keeps the last `size` durations of every database operation"""
+
+    def __init__(self, size: int = 1000):
+        self._size = size
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, operation: str, seconds: float):
+        with self._lock:
+            if operation not in self._samples:
+                self._samples[operation] = deque(maxlen=self._size)
+                self._counts[operation] = 0
+            self._samples[operation].append(seconds)
+            self._counts[operation] += 1
+
+    def summary(self) -> dict:
+        """Get count and p50/p95/p99/max latency in milliseconds per operation"""
+        with self._lock:
+            samples = {op: sorted(values) for op, values in self._samples.items()}
+            counts = dict(self._counts)
+
+        result = {}
+        for op, values in samples.items():
+            result[op] = {"count": counts[op]}
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1)):
+                index = min(int(len(values) * q), len(values) - 1)
+                result[op][name] = values[index] * 1000
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+
+class CachedDatabase(Database):
+    """Write-through LRU cache of decoded values in front of another backend.
+
+    Lists and dicts are copied in and out, so changing a returned value in
+    place doesn't change the cache behind the backend's back.
+    """
+
+    def __init__(self, backend: Database, max_size: int = 4096):
+        self._backend = backend
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.latency = LatencyStats()
+        # how often to check for writes made by other processes, in seconds;
+        # checked by a thread so reads never wait for it
+        self.sync_interval = 1.0
+        self._stopped = threading.Event()
+        threading.Thread(target=self._sync, name="db-sync", daemon=True).start()
+
+    @property
+    def backend(self) -> Database:
+        return self._backend
+
+    def _timed(self, operation: str, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.latency.add(operation, time.perf_counter() - start)
+
+    @staticmethod
+    def _copy(value):
+        return deepcopy(value) if isinstance(value, (list, dict)) else value
+
+    def _store(self, key, value, overwrite=True):
+        with self._lock:
+            if not overwrite and key in self._cache:
+                return
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def _sync(self):
+        """Drop the cache whenever another process wrote to the database"""
+        while not self._stopped.wait(self.sync_interval):
+            try:
+                if self._backend.changed_elsewhere():
+                    self.clear_cache()
+            except Exception:
+                logging.warning("Can't check for database changes", exc_info=True)
+
+    def peek(self, module: str, variable: str, default=None):
+        """Get value only if it is cached, ``NOT_CACHED`` otherwise"""
+        key = (module, variable)
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                return NOT_CACHED
+            self._cache.move_to_end(key)
+            self.hits += 1
+        return default if value is _ABSENT else self._copy(value)
+
+    def get(self, module: str, variable: str, default=None):
+        value = self.peek(module, variable, _ABSENT)
+        if value is NOT_CACHED:
+            with self._lock:
+                self.misses += 1
+            value = self._timed("get", self._backend.get, module, variable, _ABSENT)
+            # a concurrent set() may have cached a newer value meanwhile
+            self._store((module, variable), self._copy(value), overwrite=False)
+        return default if value is _ABSENT else value
+
+    def set(self, module: str, variable: str, value):
+        with self._write_lock:
+            result = self._timed("set", self._backend.set, module, variable, value)
+            self._store((module, variable), self._copy(value))
+        return result
+
+    def remove(self, module: str, variable: str):
+        with self._write_lock:
+            self._timed("remove", self._backend.remove, module, variable)
+            self._store((module, variable), _ABSENT)
+
+    def get_many(self, module: str, variables, default=None) -> dict:
+        result = {}
+        missing = []
+        for variable in variables:
+            value = self.peek(module, variable, _ABSENT)
+            if value is NOT_CACHED:
+                missing.append(variable)
+            result[variable] = value
+
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            fetched = self._timed(
+                "get_many", self._backend.get_many, module, missing, _ABSENT
+            )
+            for variable, value in fetched.items():
+                self._store((module, variable), self._copy(value), overwrite=False)
+                result[variable] = value
+
+        return {
+            variable: default if value is _ABSENT else value
+            for variable, value in result.items()
+        }
+
+    def set_many(self, module: str, values: dict):
+        with self._write_lock:
+            self._timed("set_many", self._backend.set_many, module, values)
+            for variable, value in values.items():
+                self._store((module, variable), self._copy(value))
+
+    def get_collection(self, module: str) -> dict:
+        return self._timed("get_collection", self._backend.get_collection, module)
+
+    def list_modules(self) -> list:
+        return self._backend.list_modules()
+
+    def iter_collection(self, module: str):
+        return self._backend.iter_collection(module)
+
+    def iter_chat_history(self):
+        return self._backend.iter_chat_history()
+
+    def list_vars(self, module: str, offset: int = 0, limit: int = None) -> list:
+        return self._timed("list_vars", self._backend.list_vars, module, offset, limit)
+
+    def count(self, module: str) -> int:
+        return self._timed("count", self._backend.count, module)
+
+    def probe(self, rounds: int = 20):
+        """Time uncached set/get/remove round-trips against the backend"""
+        backend = self._backend
+
+        # writes may only be queued, so time them up to their commit
+        def set_(value):
+            backend.set("core.dbstat", "probe", value)
+            backend.flush()
+
+        def remove():
+            backend.remove("core.dbstat", "probe")
+            backend.flush()
+
+        for i in range(rounds):
+            self._timed("set", set_, i)
+            self._timed("get", backend.get, "core.dbstat", "probe")
+            self._timed("remove", remove)
+
+    def close(self):
+        self._stopped.set()
+        with self._write_lock:
+            self.clear_cache()
+            self._backend.close()
+
+    def flush(self):
+        self._backend.flush()
+
+    def share(self):
+        self._backend.share()
+
+    def _forget_legacy_history(self, user_id):
+        # the backend moves old per-user history rows out behind our back
+        with self._lock:
+            self._cache.pop((f"core.cohere.user_{user_id}", "chat_history"), None)
+
+    def add_chat_history(self, user_id, message, limit: int = None):
+        self._backend.add_chat_history(user_id, message, limit)
+        self._forget_legacy_history(user_id)
+
+    def clear_chat_history(self, user_id):
+        self._backend.clear_chat_history(user_id)
+        self._forget_legacy_history(user_id)
+
+    def get_chat_history(
+        self, user_id, default=None, limit: int = None, max_tokens: int = None
+    ):
+        chat_history = self._backend.get_chat_history(
+            user_id, default, limit, max_tokens
+        )
+        self._forget_legacy_history(user_id)
+        return chat_history
+
+    def clear_cache(self):
+        """Drop every cached value"""
+        with self._lock:
+            self._cache.clear()
+
+    def cache_stats(self) -> dict:
+        """Get cache size and hit/miss counters"""
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "max_size": self._max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class AsyncDatabase:
+    """Awaitable database API that keeps blocking driver calls off the event loop.
+
+    Calls run in a dedicated executor; values already held by a
+    ``CachedDatabase`` are returned without leaving the event loop.
+    """
+
+    max_workers = 1
+
+    def __init__(self, database: Database):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="db"
+        )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def aget(self, module: str, variable: str, default=None):
+        """Get value from database"""
+        if isinstance(self.sync, CachedDatabase):
+            value = self.sync.peek(module, variable, default)
+            if value is not NOT_CACHED:
+                return value
+        return await self._run(self.sync.get, module, variable, default)
+
+    async def aset(self, module: str, variable: str, value):
+        """Set key in database"""
+        return await self._run(self.sync.set, module, variable, value)
+
+    async def aremove(self, module: str, variable: str):
+        """Remove key from database"""
+        return await self._run(self.sync.remove, module, variable)
+
+    async def aget_collection(self, module: str) -> dict:
+        """Get database for selected module"""
+        return await self._run(self.sync.get_collection, module)
+
+    async def alist_vars(self, module: str, offset: int = 0, limit: int = None):
+        """Get sorted keys of selected module, optionally one page of them"""
+        return await self._run(self.sync.list_vars, module, offset, limit)
+
+    async def aget_many(self, module: str, variables, default=None) -> dict:
+        """Get several values of a module at once"""
+        return await self._run(self.sync.get_many, module, list(variables), default)
+
+    async def aset_many(self, module: str, values: dict):
+        """Set several keys of a module at once"""
+        return await self._run(self.sync.set_many, module, values)
+
+    async def aclose(self):
+        """Close the database and stop the executor"""
+        await self._run(self.sync.close)
+        self._executor.shutdown(wait=False)
+
+
+class AsyncSqliteDatabase(AsyncDatabase):
+    # one connection, so queries are serialized by a single worker thread
+    max_workers = 1
+
+
+class AsyncMongoDatabase(AsyncDatabase):
+    # pymongo clients are thread-safe and pool their connections
+    max_workers = 8
 
 
 if config.db_type in ["mongo", "mongodb"]:
-    db = MongoDatabase(config.db_url, config.db_name)
+    db = CachedDatabase(
+        MongoDatabase(
+            config.db_url,
+            config.db_name,
+            pool_size=config.db_pool_size,
+            timeout_ms=config.db_timeout_ms,
+            nameserver=config.db_nameserver,
+            shared=config.db_shared or bool(config.second_session),
+        ),
+        config.db_cache_size,
+    )
+    adb = AsyncMongoDatabase(db)
+elif config.db_type == "mongomock":
+    # in-memory stand-in for tests and offline containers
+    import mongomock
+
+    db = CachedDatabase(
+        MongoDatabase(
+            None,
+            config.db_name,
+            client=mongomock.MongoClient(),
+            shared=config.db_shared,
+        ),
+        config.db_cache_size,
+    )
+    adb = AsyncMongoDatabase(db)
 else:
-    db = SqliteDatabase(config.db_name)
+    db = CachedDatabase(
+        SqliteDatabase(
+            config.db_name,
+            commit_interval=config.db_commit_interval,
+            commit_every=config.db_commit_every,
+            busy_timeout=config.db_busy_timeout,
+        ),
+        config.db_cache_size,
+    )
+    adb = AsyncSqliteDatabase(db)
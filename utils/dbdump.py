@@ -0,0 +1,104 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Streaming database snapshots in gzip-compressed newline-delimited JSON.
+
+Every line is either a module value
+``{"module": "core.notes", "var": "chat_id", "val": -100123}``
+or a chat history entry ``{"history": 12345, "message": {...}}``.
+
+Loading overwrites the values in the snapshot and replaces the chat history
+of every user in it, so loading the same file twice gives the same database.
+
+Usage: python -m utils.dbdump dump|load FILE
+"""
+
+import gzip
+import json
+import sys
+import time
+from typing import Tuple
+
+from utils.db import Database
+
+
+def dump(database: Database, path: str) -> Tuple[int, float]:
+    """Write every module and chat history to `path`, returns (rows, seconds)"""
+    start = time.perf_counter()
+    rows = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for module in database.list_modules():
+            for var, val in database.iter_collection(module):
+                record = {"module": module, "var": var, "val": val}
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                rows += 1
+        for user_id, message in database.iter_chat_history():
+            record = {"history": user_id, "message": message}
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            rows += 1
+    return rows, time.perf_counter() - start
+
+
+def load(database: Database, path: str, batch_size: int = 500) -> Tuple[int, float]:
+    """Restore a snapshot written by `dump()`, returns (rows, seconds)"""
+    start = time.perf_counter()
+    rows = 0
+    module, batch = None, {}
+    # users whose existing history was already replaced
+    history_users = set()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            rows += 1
+
+            if "history" in record:
+                user_id = record["history"]
+                if user_id not in history_users:
+                    database.clear_chat_history(user_id)
+                    history_users.add(user_id)
+                database.add_chat_history(user_id, record["message"])
+                continue
+
+            if record["module"] != module or len(batch) >= batch_size:
+                if batch:
+                    database.set_many(module, batch)
+                module, batch = record["module"], {}
+            batch[record["var"]] = record["val"]
+
+    if batch:
+        database.set_many(module, batch)
+    database.flush()
+    return rows, time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ("dump", "load"):
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+
+    from utils.db import db
+
+    action, path = sys.argv[1:]
+    rows, seconds = (dump if action == "dump" else load)(db, path)
+    db.close()
+    rate = rows / max(seconds, 1e-9)
+    print(f"{action}: {rows} rows in {seconds:.2f}s ({rate:.0f} rows/sec)")
+
+
+if __name__ == "__main__":
+    main()
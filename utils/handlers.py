@@ -1117,7 +1117,7 @@ class NoteSendHandler:
             await self.message.edit("<b>Loading...</b>")
 
             note_name = self.message.text.split(maxsplit=1)[1]
-            find_note = db.get("core.notes", f"note{note_name}", False)
+            find_note = db.get("core.notes.list", note_name, False)
             if find_note:
                 try:
                     await self.send_note(find_note)
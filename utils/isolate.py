@@ -0,0 +1,317 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Run a custom module in its own process.
+
+A module with a ``# meta isolate: process`` comment is imported by a worker
+(``python -m utils.isolate``) instead of the main process. The main process
+matches the module's commands and forwards the messages over a socket pair;
+in the worker, ``client`` and the ``_client`` of every message are proxies
+that send method calls back to the real client. Blocking or CPU-heavy code
+in the module then only stalls its own worker.
+
+Frames are pickled tuples prefixed with their length:
+  main -> worker: ("init", me), ("update", group, message), ("result", id, ok, value)
+  worker -> main: ("call", id, method, args, kwargs)
+"""
+
+import asyncio
+import importlib
+import inspect
+import itertools
+import logging
+import os
+import pickle
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from pyrogram import Client
+from pyrogram.types import Message
+from pyrogram.types.object import Object
+
+# worker exit code when the module can't be imported, it isn't restarted then
+IMPORT_FAILED = 3
+STOP_TIMEOUT = 5
+
+
+def _bind(value, client):
+    if isinstance(value, Object):
+        value.bind(client)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _bind(item, client)
+    return value
+
+
+def _picklable_exception(e: Exception) -> Exception:
+    try:
+        return pickle.loads(pickle.dumps(e))
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+class Channel:
+    """Length-prefixed pickle frames over a stream, with request/response calls"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._ids = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def send(self, *frame):
+        data = pickle.dumps(frame)
+        self.writer.write(len(data).to_bytes(4, "big") + data)
+        await self.writer.drain()
+
+    async def receive(self) -> tuple | None:
+        try:
+            size = int.from_bytes(await self.reader.readexactly(4), "big")
+            return pickle.loads(await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def call(self, method: str, args: tuple, kwargs: dict):
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = future
+        try:
+            await self.send("call", call_id, method, args, kwargs)
+            return await future
+        finally:
+            self._pending.pop(call_id, None)
+
+    def resolve(self, call_id: int, ok: bool, value):
+        future = self._pending.get(call_id)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def close(self):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("main process went away"))
+        self.writer.close()
+
+
+class IsolatedModule:
+    """Main process side: the worker of one module, started on first use"""
+
+    def __init__(self, module_name: str, path: str, client: Client):
+        self.module_name = module_name
+        self.path = path
+        self.client = client
+        self.broken = False
+        self._process = None
+        self._channel = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    async def start(self):
+        parent, child = socket.socketpair()
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-m",
+                "utils.isolate",
+                self.path,
+                str(child.fileno()),
+                pass_fds=(child.fileno(),),
+                # the worker opens the database too, writes must be seen by both
+                env={**os.environ, "DATABASE_SHARED": "True"},
+            )
+        finally:
+            child.close()
+        reader, writer = await asyncio.open_connection(sock=parent)
+        self._channel = Channel(reader, writer)
+        await self._channel.send("init", self.client.me)
+        self._spawn(self._serve(self._channel, self._process))
+        logging.info("Started worker process for module %s", self.module_name)
+
+    async def forward(self, group: int, message: Message):
+        if self.broken:
+            return
+        async with self._lock:
+            if not self.running:
+                await self.start()
+        try:
+            await self._channel.send("update", group, message)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            logging.warning(
+                "Can't pass message to module %s", self.module_name, exc_info=True
+            )
+
+    async def stop(self):
+        if self._channel is not None:
+            self._channel.close()
+        if self.running:
+            try:
+                await asyncio.wait_for(self._process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._process.kill()
+        for task in self._tasks:
+            task.cancel()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _serve(self, channel: Channel, process):
+        while (frame := await channel.receive()) is not None:
+            _, call_id, method, args, kwargs = frame
+            self._spawn(self._call(channel, call_id, method, args, kwargs))
+
+        returncode = await process.wait()
+        if returncode == IMPORT_FAILED:
+            self.broken = True
+            logging.warning("Can't import module %s in worker", self.module_name)
+        elif returncode:
+            logging.warning(
+                "Worker of module %s exited with code %s", self.module_name, returncode
+            )
+
+    async def _call(self, channel: Channel, call_id: int, method, args, kwargs):
+        try:
+            if method.startswith("_"):
+                raise AttributeError(f"{method} can't be called from a worker")
+            _bind(args, self.client)
+            _bind(list(kwargs.values()), self.client)
+            result = getattr(self.client, method)(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            if inspect.isasyncgen(result):
+                result = [item async for item in result]
+        except Exception as e:
+            await channel.send("result", call_id, False, _picklable_exception(e))
+            return
+
+        try:
+            await channel.send("result", call_id, True, result)
+        except Exception as e:
+            await channel.send("result", call_id, False, _picklable_exception(e))
+
+
+class RemoteCall:
+    """Awaitable, or async iterable for methods like get_chat_history"""
+
+    def __init__(self, client: "RemoteClient", method: str, args, kwargs):
+        self._client = client
+        self._call = (method, args, kwargs)
+
+    def __await__(self):
+        return self._client._request(*self._call).__await__()
+
+    async def __aiter__(self):
+        for item in await self:
+            yield item
+
+
+class RemoteClient:
+    """Worker side stand-in for the main process' Client"""
+
+    def __init__(self, channel: Channel, me):
+        self._channel = channel
+        self.me = _bind(me, self)
+        # used by pyrogram to run synchronous filters and handlers
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(4, thread_name_prefix="isolated")
+
+    def __getattr__(self, method: str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: RemoteCall(self, method, args, kwargs)
+
+    async def _request(self, method: str, args: tuple, kwargs: dict):
+        return _bind(await self._channel.call(method, args, kwargs), self)
+
+
+async def _matches(client: RemoteClient, handler, message: Message) -> bool:
+    # Handler.check() without pyrofork's listeners, which live in the main process
+    flt = handler.filters
+    if not callable(flt):
+        return True
+    if inspect.iscoroutinefunction(flt.__call__):
+        return await flt(client, message)
+    return await client.loop.run_in_executor(client.executor, flt, client, message)
+
+
+async def _dispatch(client: RemoteClient, handlers: List, message: Message):
+    """First handler of the group whose filters pass, like pyrogram does"""
+    for handler in handlers:
+        try:
+            if not await _matches(client, handler, message):
+                continue
+            # pyrofork wraps the callback to resolve listeners, skip that too
+            callback = getattr(handler, "original_callback", handler.callback)
+            if inspect.iscoroutinefunction(callback):
+                await callback(client, message)
+            else:
+                await client.loop.run_in_executor(
+                    client.executor, callback, client, message
+                )
+        except Exception:
+            logging.exception("Error in isolated handler")
+        break
+
+
+async def worker(path: str, fd: int):
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd))
+    channel = Channel(reader, writer)
+    _, me = await channel.receive()
+    client = RemoteClient(channel, me)
+
+    try:
+        module = importlib.import_module(path)
+    except Exception:
+        logging.exception("Can't import %s", path)
+        sys.exit(IMPORT_FAILED)
+
+    from utils.scripts import _module_handlers
+
+    groups: Dict[int, List] = {}
+    for handler, group in _module_handlers(module):
+        groups.setdefault(group, []).append(handler)
+
+    tasks = set()
+    while (frame := await channel.receive()) is not None:
+        if frame[0] == "result":
+            channel.resolve(*frame[1:])
+        elif frame[0] == "update":
+            _, group, message = frame
+            task = asyncio.create_task(
+                _dispatch(client, groups.get(group, []), _bind(message, client))
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    channel.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - worker - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(worker(sys.argv[1], int(sys.argv[2])))
@@ -0,0 +1,195 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Static analysis of modules for lazy loading.
+
+A module can be loaded lazily when everything it registers is a
+``@Client.on_message(filters.command(...) & ...)`` handler and its help is a
+literal ``modules_help["name"] = {...}``, so both can be read from the source
+without importing it. Modules with import side effects that matter can opt
+out with a ``# meta lazy: no`` comment.
+"""
+
+import ast
+from typing import Dict, List, Optional, Tuple
+
+# pyrogram's default when filters.command() is called without prefixes
+DEFAULT_PREFIXES = ("/",)
+
+
+class LazyCommand:
+    """Commands of one handler, `prefixes` is None for the configured prefix"""
+
+    def __init__(
+        self,
+        commands: Tuple[str, ...],
+        prefixes: Optional[Tuple[str, ...]],
+        group: int,
+        me: bool,
+    ):
+        self.commands = commands
+        self.prefixes = prefixes
+        self.group = group
+        self.me = me
+
+
+class LazySpec:
+    def __init__(self, commands: List[LazyCommand], help: Dict[str, dict]):
+        self.commands = commands
+        self.help = help
+
+
+def _strings(node: ast.expr) -> Optional[Tuple[str, ...]]:
+    try:
+        value = ast.literal_eval(node)
+    except (ValueError, TypeError):
+        return None
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+        return tuple(value)
+    return None
+
+
+def _is_attr(node: ast.expr, owner: str, attr: str = None) -> bool:
+    return (
+        isinstance(node, ast.Attribute)
+        and isinstance(node.value, ast.Name)
+        and node.value.id == owner
+        and (attr is None or node.attr == attr)
+    )
+
+
+def _and_operands(node: ast.expr) -> List[ast.expr]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+        return _and_operands(node.left) + _and_operands(node.right)
+    return [node]
+
+
+def _parse_command(node: ast.Call) -> Optional[Tuple[tuple, Optional[tuple]]]:
+    args = list(node.args)
+    for keyword in node.keywords:
+        if keyword.arg == "commands" and len(args) == 0:
+            args.append(keyword.value)
+        elif keyword.arg == "prefixes" and len(args) == 1:
+            args.append(keyword.value)
+        else:
+            return None
+    if not 1 <= len(args) <= 2:
+        return None
+
+    commands = _strings(args[0])
+    if not commands:
+        return None
+    if len(args) == 1:
+        return commands, DEFAULT_PREFIXES
+    if isinstance(args[1], ast.Name) and args[1].id == "prefix":
+        return commands, None
+    prefixes = _strings(args[1])
+    if prefixes is None:
+        return None
+    return commands, prefixes
+
+
+def _parse_handler(decorator: ast.expr) -> Optional[LazyCommand]:
+    if not (
+        isinstance(decorator, ast.Call)
+        and _is_attr(decorator.func, "Client", "on_message")
+    ):
+        return None
+
+    args = list(decorator.args)
+    group = 0
+    for keyword in decorator.keywords:
+        if keyword.arg == "filters" and not args:
+            args.append(keyword.value)
+        elif keyword.arg == "group" and isinstance(keyword.value, ast.Constant):
+            group = keyword.value.value
+        else:
+            return None
+    if len(args) == 2 and isinstance(args[1], ast.Constant):
+        group = args.pop().value
+    if len(args) != 1 or not isinstance(group, int):
+        return None
+
+    operands = _and_operands(args[0])
+    commands = [
+        op
+        for op in operands
+        if isinstance(op, ast.Call) and _is_attr(op.func, "filters", "command")
+    ]
+    if len(commands) != 1:
+        return None
+    parsed = _parse_command(commands[0])
+    if parsed is None:
+        return None
+
+    me = any(_is_attr(op, "filters", "me") for op in operands)
+    return LazyCommand(parsed[0], parsed[1], group, me)
+
+
+def _parse_help(node: ast.stmt) -> Optional[Tuple[str, dict]]:
+    if not (
+        isinstance(node, ast.Assign)
+        and len(node.targets) == 1
+        and isinstance(node.targets[0], ast.Subscript)
+        and isinstance(node.targets[0].value, ast.Name)
+        and node.targets[0].value.id == "modules_help"
+    ):
+        return None
+    try:
+        name = ast.literal_eval(node.targets[0].slice)
+        value = ast.literal_eval(node.value)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(name, str) or not isinstance(value, dict):
+        return None
+    return name, value
+
+
+def scan_module(code: str) -> Optional[LazySpec]:
+    """
+    Read commands and help of a module without importing it
+    :return: None if the module registers anything that can't be read statically
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    client_refs = 0
+    help_refs = 0
+    for node in ast.walk(tree):
+        if _is_attr(node, "Client") and node.attr.startswith("on_"):
+            client_refs += 1
+        elif isinstance(node, ast.Name) and node.id == "modules_help":
+            help_refs += 1
+
+    commands = []
+    help = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for decorator in node.decorator_list:
+                command = _parse_handler(decorator)
+                if command is not None:
+                    commands.append(command)
+        elif (parsed := _parse_help(node)) is not None:
+            help[parsed[0]] = parsed[1]
+
+    # every handler and help entry must have been understood
+    if not commands or client_refs != len(commands) or help_refs != len(help):
+        return None
+    return LazySpec(commands, help)
@@ -0,0 +1,87 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from utils.db import Database
+
+# Storage layout versions:
+#   1 - notes as `note{name}` keys in core.notes, filters as one dict per chat
+#       in core.filters, antipm approvals as `allowusers{id}` keys in core.antipm
+#   2 - one key per note in core.notes.list, one key per trigger in
+#       core.filters.{chat_id}, one key per approved user in core.antipm.allowed
+STORAGE_LAYOUT = 2
+
+NOTES = "core.notes.list"
+ANTIPM_ALLOWED = "core.antipm.allowed"
+
+
+def filters_module(chat_id) -> str:
+    return f"core.filters.{chat_id}"
+
+
+def _migrate_notes(db: Database):
+    legacy = db.get_collection("core.notes")
+    notes = {
+        name[4:]: note
+        for name, note in legacy.items()
+        if name.startswith("note") and isinstance(note, dict)
+    }
+    db.set_many(NOTES, notes)
+    for name in notes:
+        db.remove("core.notes", f"note{name}")
+    return len(notes)
+
+
+def _migrate_filters(db: Database):
+    migrated = 0
+    for chat_id, chat_filters in db.get_collection("core.filters").items():
+        if isinstance(chat_filters, dict):
+            db.set_many(filters_module(chat_id), chat_filters)
+            migrated += len(chat_filters)
+        db.remove("core.filters", chat_id)
+    return migrated
+
+
+def _migrate_antipm(db: Database):
+    allowed = {}
+    for name, value in db.get_collection("core.antipm").items():
+        if name.startswith("allowusers"):
+            allowed[str(value)] = True
+        elif not name.startswith("disallowusers"):
+            continue
+        db.remove("core.antipm", name)
+    db.set_many(ANTIPM_ALLOWED, allowed)
+    return len(allowed)
+
+
+def migrate_storage_layout(db: Database):
+    """Move notes, filters and antipm approvals to their per-key modules"""
+    if db.get("core.main", "storage_layout", 1) >= STORAGE_LAYOUT:
+        return
+
+    notes = _migrate_notes(db)
+    filters = _migrate_filters(db)
+    allowed = _migrate_antipm(db)
+    db.set("core.main", "storage_layout", STORAGE_LAYOUT)
+    db.flush()
+
+    logging.info(
+        "Migrated storage layout: %s notes, %s filters, %s approved users",
+        notes,
+        filters,
+        allowed,
+    )
@@ -14,9 +14,10 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
+import os
 from sys import version_info
 from .db import db
-import git
 
 __all__ = [
     "modules_help",
@@ -25,8 +26,11 @@ __all__ = [
     "prefix",
     "gitrepo",
     "userbot_version",
+    "commit_hash",
 ]
 
+# version and commit computed by git, refreshed when HEAD moves
+VERSION_FILE = ".version.json"
 
 modules_help = {}
 requirements_list = []
@@ -35,21 +39,83 @@ python_version = f"{version_info[0]}.{version_info[1]}.{version_info[2]}"
 
 prefix = db.get("core.main", "prefix", ".")
 
-try:
-    gitrepo = git.Repo(".")
-except git.exc.InvalidGitRepositoryError:
-    repo = git.Repo.init()
-    origin = repo.create_remote(
-        "origin", "https://github.com/The-MoonTg-project/Moon-Userbot"
-    )
-    origin.fetch()
-    repo.create_head("main", origin.refs.main)
-    repo.heads.main.set_tracking_branch(origin.refs.main)
-    repo.heads.main.checkout(True)
-    gitrepo = git.Repo(".")
-
-if len(gitrepo.tags) > 0:
-    commits_since_tag = list(gitrepo.iter_commits(f"{gitrepo.tags[-1].name}..HEAD"))
-else:
-    commits_since_tag = []
-userbot_version = f"2.0.{len(commits_since_tag)}"
+
+def _open_repo():
+    import git
+
+    try:
+        return git.Repo(".")
+    except git.exc.InvalidGitRepositoryError:
+        repo = git.Repo.init()
+        origin = repo.create_remote(
+            "origin", "https://github.com/The-MoonTg-project/Moon-Userbot"
+        )
+        origin.fetch()
+        repo.create_head("main", origin.refs.main)
+        repo.heads.main.set_tracking_branch(origin.refs.main)
+        repo.heads.main.checkout(True)
+        return git.Repo(".")
+
+
+def _head_commit() -> str | None:
+    """Read the HEAD commit from .git without starting git"""
+    try:
+        with open(".git/HEAD", encoding="utf-8") as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        if os.path.exists(f".git/{ref}"):
+            with open(f".git/{ref}", encoding="utf-8") as f:
+                return f.read().strip()
+        with open(".git/packed-refs", encoding="utf-8") as f:
+            for line in f:
+                if line.rstrip().endswith(f" {ref}"):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def write_version_info() -> dict:
+    """Compute version and commit with git and store them in VERSION_FILE"""
+    repo = _open_repo()
+    if len(repo.tags) > 0:
+        commits_since_tag = sum(
+            1 for _ in repo.iter_commits(f"{repo.tags[-1].name}..HEAD")
+        )
+    else:
+        commits_since_tag = 0
+
+    info = {
+        "version": f"2.0.{commits_since_tag}",
+        "commit": repo.head.commit.hexsha,
+    }
+    with open(VERSION_FILE, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+
+def read_version_info() -> dict:
+    try:
+        with open(VERSION_FILE, encoding="utf-8") as f:
+            info = json.load(f)
+        head = _head_commit()
+        if head is None or head == info["commit"]:
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    return write_version_info()
+
+
+_version_info = read_version_info()
+userbot_version = _version_info["version"]
+commit_hash = _version_info["commit"]
+
+
+def __getattr__(name):
+    # opening the repository is slow, only do it for modules that need it
+    if name == "gitrepo":
+        globals()["gitrepo"] = _open_repo()
+        return globals()["gitrepo"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
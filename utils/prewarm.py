@@ -0,0 +1,128 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Install the requirements of all modules and compile them ahead of time.
+
+Runs in the background after startup, or by hand before a restart.
+
+Usage: python -m utils.prewarm
+"""
+
+import asyncio
+import compileall
+import importlib
+import importlib.metadata
+import logging
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from utils.scripts import read_meta
+
+MODULES_PATH = "modules"
+PIP_TIMEOUT = 600
+# distribution name at the start of a requirement like "aiohttp[speedups]>=3.9"
+REQUIREMENT_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+def module_files() -> List[Path]:
+    return list(Path(MODULES_PATH).rglob("*.py"))
+
+
+def module_requirements(files: List[Path]) -> List[str]:
+    """`# meta requires:` packages of all modules, without duplicates"""
+    packages = {}
+    for file in files:
+        for package in read_meta(str(file)).get("requires", "").split():
+            packages[package] = None
+    return list(packages)
+
+
+def is_installed(requirement: str) -> bool:
+    match = REQUIREMENT_NAME.match(requirement)
+    if match is None:
+        # urls and paths can't be checked, leave them to pip
+        return False
+    try:
+        importlib.metadata.distribution(match.group())
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    return True
+
+
+def missing_requirements(files: List[Path]) -> List[str]:
+    return [p for p in module_requirements(files) if not is_installed(p)]
+
+
+def pip_install_args(packages: List[str]) -> List[str]:
+    return [sys.executable, "-m", "pip", "install", "-U", *packages]
+
+
+def compile_modules(workers: int = 1) -> bool:
+    """Write .pyc files for every module, unchanged files are skipped"""
+    return compileall.compile_dir(MODULES_PATH, quiet=1, workers=workers)
+
+
+async def prewarm(files: List[Path] = None):
+    """Install missing requirements in one pip run, then compile all modules"""
+    loop = asyncio.get_running_loop()
+    files = files if files is not None else module_files()
+    missing = await loop.run_in_executor(None, missing_requirements, files)
+
+    if missing:
+        logging.info("Installing module requirements: %s", " ".join(missing))
+        proc = await asyncio.create_subprocess_exec(
+            *pip_install_args(missing),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), PIP_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            logging.warning("Timeout while installing module requirements")
+        else:
+            if proc.returncode != 0:
+                logging.warning(
+                    "Failed to install module requirements (pip exited with code %s)"
+                    "\n%s",
+                    proc.returncode,
+                    stderr.decode("utf-8", "replace").strip(),
+                )
+        importlib.invalidate_caches()
+
+    await loop.run_in_executor(None, compile_modules)
+
+
+def main():
+    start = time.perf_counter()
+    files = module_files()
+    missing = missing_requirements(files)
+    if missing:
+        print(f"Installing: {' '.join(missing)}")
+        subprocess.run(pip_install_args(missing), check=True)
+    else:
+        print("All module requirements are installed")
+
+    compile_modules(workers=0)
+    print(f"Compiled {len(files)} modules in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
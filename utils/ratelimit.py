@@ -0,0 +1,134 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Token buckets for automatic replies.
+
+Every (module, chat) pair has a bucket holding up to ``burst`` replies that
+refills at ``rate`` replies per minute. A reply is sent only if it can take a
+token, otherwise it is counted as suppressed. Limits come from the
+``RATE_LIMIT_PER_MINUTE`` / ``RATE_LIMIT_BURST`` env vars and can be
+overridden per module or per chat in the ``core.ratelimit`` collection:
+``"<module>"`` or ``"<module>.<chat_id>"`` -> ``[rate, burst]``. A rate of 0
+turns limiting off.
+"""
+
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Tuple
+
+from utils import config
+from utils.db import db
+
+# buckets that weren't used for a while are full again, dropping them is free
+MAX_BUCKETS = 4096
+
+
+class RateLimiter:
+    def __init__(self, database, rate: float, burst: int):
+        self.db = database
+        self.default = (rate, burst)
+        # (module, chat_id) -> [tokens, last refill]
+        self._buckets: "OrderedDict[Tuple[str, int], list]" = OrderedDict()
+        # overrides from core.ratelimit, read on first use
+        self._limits: Dict[str, tuple] | None = None
+        # module -> replies sent / skipped
+        self.sent = Counter()
+        self.skipped = Counter()
+        # (module, chat_id) -> replies skipped, trimmed to the noisiest chats
+        self.suppressed = Counter()
+
+    @property
+    def overrides(self) -> Dict[str, tuple]:
+        if self._limits is None:
+            self._limits = {
+                key: tuple(value)
+                for key, value in self.db.get_collection("core.ratelimit").items()
+            }
+        return self._limits
+
+    def limits(self, module: str, chat_id: int = None) -> Tuple[float, int]:
+        """(rate per minute, burst) for a chat, falling back to module and default"""
+        overrides = self.overrides
+        if chat_id is not None and overrides:
+            limit = overrides.get(f"{module}.{chat_id}")
+            if limit is not None:
+                return limit
+        return overrides.get(module, self.default)
+
+    def set_limits(self, module: str, chat_id: int = None, rate=None, burst=None):
+        """Override the limits, or remove the override if rate is None"""
+        key = module if chat_id is None else f"{module}.{chat_id}"
+        if rate is None:
+            self.db.remove("core.ratelimit", key)
+            self.overrides.pop(key, None)
+        else:
+            self.db.set("core.ratelimit", key, [rate, burst])
+            self.overrides[key] = (rate, burst)
+        # affected chats start over with full buckets under the new limits
+        for bucket_key in [k for k in self._buckets if k[0] == module]:
+            if chat_id is None or bucket_key[1] == chat_id:
+                del self._buckets[bucket_key]
+
+    def allow(self, module: str, chat_id: int) -> bool:
+        """Take a token for a reply, False if the reply should be skipped"""
+        rate, burst = self.limits(module, chat_id)
+        key = (module, chat_id)
+        if rate <= 0:
+            self.sent[module] += 1
+            return True
+
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now]
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate / 60)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.skipped[module] += 1
+            self.suppressed[key] += 1
+            if len(self.suppressed) > MAX_BUCKETS:
+                # halved, so trimming happens once per many new chats
+                self.suppressed = Counter(
+                    dict(self.suppressed.most_common(MAX_BUCKETS // 2))
+                )
+            return False
+        bucket[0] -= 1
+        self.sent[module] += 1
+        return True
+
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        """module -> (sent, suppressed) since start"""
+        return {
+            module: (self.sent[module], self.skipped[module])
+            for module in sorted(self.sent.keys() | self.skipped.keys())
+        }
+
+    def noisiest(self, top: int = 10):
+        """((module, chat_id), suppressed) with the most skipped replies"""
+        return self.suppressed.most_common(top)
+
+    def reset_stats(self):
+        self.sent.clear()
+        self.skipped.clear()
+        self.suppressed.clear()
+
+
+limiter = RateLimiter(db, config.ratelimit_rate, config.ratelimit_burst)
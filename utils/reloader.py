@@ -0,0 +1,84 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Reload modules in place when their files change, without a restart"""
+
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict
+
+from pyrogram import Client
+
+from utils.scripts import load_module, reload_module, unload_module
+
+MODULES_PATH = Path("modules")
+
+
+def _snapshot() -> Dict[Path, float]:
+    mtimes = {}
+    for file in MODULES_PATH.rglob("*.py"):
+        try:
+            mtimes[file] = os.stat(file).st_mtime
+        except FileNotFoundError:
+            pass
+    return mtimes
+
+
+def _is_core(file: Path) -> bool:
+    return "custom_modules" not in file.parent.parts
+
+
+async def watch_modules(client: Client, interval: float = 1.0):
+    """
+    Poll module files and reload the ones that changed. A change is applied
+    once the file stayed the same for one poll, so half-written files from
+    an editor or a download are skipped.
+    """
+    loaded = _snapshot()
+    seen = dict(loaded)
+
+    while True:
+        await asyncio.sleep(interval)
+        current = _snapshot()
+
+        for file, mtime in current.items():
+            if mtime != seen.get(file) or mtime == loaded.get(file):
+                continue
+
+            name, core = file.stem, _is_core(file)
+            start = time.perf_counter()
+            try:
+                if file in loaded:
+                    await reload_module(name, client, core=core)
+                else:
+                    await load_module(name, client, core=core)
+            except Exception:
+                logging.warning("Can't reload module %s", name, exc_info=True)
+            else:
+                elapsed = (time.perf_counter() - start) * 1000
+                logging.info("Reloaded module %s in %.1f ms", name, elapsed)
+            # a broken file is retried only after it changes again
+            loaded[file] = mtime
+
+        for file in loaded.keys() - current.keys():
+            await unload_module(file.stem, client, core=_is_core(file))
+            logging.info("Unloaded removed module %s", file.stem)
+            del loaded[file]
+
+        seen = current
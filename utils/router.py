@@ -0,0 +1,182 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Dispatch command handlers through a dict lookup.
+
+Pyrogram tries the filters of every handler in a group until one passes, so
+each message used to run the command filter of every module. Handlers whose
+filter is ``filters.command(...)``, optionally combined with ``&``, are kept
+in a dict keyed by (prefix, command) instead. Consecutive command handlers
+of a group share one pyrogram handler, a segment, that reads the command once,
+looks up the candidates and runs their original filters in the order they
+were added. A non-command handler added in between closes the segment and the
+next command handler opens a new one after it, so every handler keeps its
+position and the first match is the same as before. Only handlers added
+through the router count, ones passed to ``client.add_handler`` directly
+aren't known to it.
+"""
+
+import inspect
+import itertools
+import re
+from typing import Dict, List, Tuple
+
+from pyrogram import Client, filters
+from pyrogram.filters import AndFilter, Filter
+from pyrogram.handlers import MessageHandler
+from pyrogram.types import Message
+
+from utils import config
+
+# commands that pyrogram's regex would match literally
+PLAIN_COMMAND = re.compile(r"[\w-]+")
+
+
+def _command_filter(flt: Filter) -> Filter | None:
+    """The command filter of an & chain, if there is exactly one"""
+    stack, found = [flt], []
+    while stack:
+        current = stack.pop()
+        if isinstance(current, AndFilter):
+            stack.extend((current.base, current.other))
+        elif type(current).__name__ == "CommandFilter":
+            found.append(current)
+    if len(found) != 1:
+        return None
+
+    command = found[0]
+    if getattr(command, "case_sensitive", False):
+        return None
+    if not all(PLAIN_COMMAND.fullmatch(c) for c in command.commands):
+        return None
+    return command
+
+
+class Segment:
+    """Consecutive command handlers of a group behind one pyrogram handler"""
+
+    def __init__(self):
+        # (prefix, command) -> [(order, handler)]
+        self.routes: Dict[Tuple[str, str], List[tuple]] = {}
+        # prefixes used in the segment, longest first
+        self.prefixes: List[str] = []
+
+        async def match(_, client: Client, message: Message):
+            return await self._match(client, message)
+
+        self.handler = MessageHandler(
+            self._dispatch, filters.create(match, "CommandRouter")
+        )
+
+    def add(self, order: int, handler: MessageHandler, keys: List[Tuple[str, str]]):
+        for key in keys:
+            self.routes.setdefault(key, []).append((order, handler))
+        self._update_prefixes()
+
+    def remove(self, handler: MessageHandler, keys: List[Tuple[str, str]]):
+        for key in keys:
+            routes = [route for route in self.routes[key] if route[1] is not handler]
+            if routes:
+                self.routes[key] = routes
+            else:
+                del self.routes[key]
+        self._update_prefixes()
+
+    def _update_prefixes(self):
+        self.prefixes = sorted(
+            {prefix for prefix, _ in self.routes}, key=len, reverse=True
+        )
+
+    def candidates(self, text: str) -> List[MessageHandler]:
+        found = []
+        for prefix in self.prefixes:
+            if not text.startswith(prefix):
+                continue
+            words = text[len(prefix) :].split(maxsplit=1)
+            if not words:
+                continue
+            # "cmd@username" addresses the same command
+            command = words[0].split("@", 1)[0].lower()
+            found.extend(self.routes.get((prefix, command), ()))
+        if len(found) > 1:
+            found.sort(key=lambda route: route[0])
+        return [handler for _, handler in found]
+
+    async def _match(self, client: Client, message: Message) -> bool:
+        text = message.text or message.caption
+        if not text:
+            return False
+        for handler in self.candidates(text):
+            if await handler.check(client, message):
+                # picked up by _dispatch() right after, for this segment
+                message._routed_handler = handler
+                return True
+        return False
+
+    @staticmethod
+    async def _dispatch(client: Client, message: Message):
+        handler = message._routed_handler
+        del message._routed_handler
+        if inspect.iscoroutinefunction(handler.callback):
+            await handler.callback(client, message)
+        else:
+            await client.loop.run_in_executor(
+                client.executor, handler.callback, client, message
+            )
+
+
+class CommandRouter:
+    def __init__(self):
+        # group -> segment that the next command handler joins, if still open
+        self._open: Dict[int, Segment] = {}
+        # routed handler -> its segment and keys, for removal
+        self._routed: Dict[MessageHandler, Tuple[Segment, List[tuple]]] = {}
+        self._order = itertools.count()
+
+    def add_handler(self, client: Client, handler: MessageHandler, group: int = 0):
+        command = None
+        if config.command_router and isinstance(handler, MessageHandler):
+            command = _command_filter(handler.filters)
+        if command is None:
+            # keeps its place between the command handlers before and after it
+            self._open.pop(group, None)
+            client.add_handler(handler, group)
+            return
+
+        segment = self._open.get(group)
+        if segment is None:
+            segment = self._open[group] = Segment()
+            client.add_handler(segment.handler, group)
+
+        keys = [(p, c) for p in command.prefixes for c in command.commands]
+        segment.add(next(self._order), handler, keys)
+        self._routed[handler] = (segment, keys)
+
+    def remove_handler(self, client: Client, handler: MessageHandler, group: int = 0):
+        routed = self._routed.pop(handler, None)
+        if routed is None:
+            client.remove_handler(handler, group)
+            return
+
+        segment, keys = routed
+        segment.remove(handler, keys)
+        if not segment.routes:
+            client.remove_handler(segment.handler, group)
+            if self._open.get(group) is segment:
+                del self._open[group]
+
+
+router = CommandRouter()
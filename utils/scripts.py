@@ -16,32 +16,54 @@
 
 import asyncio
 import importlib
+import logging
 import math
 import os
 import re
 import shlex
 import subprocess
 import sys
+import threading
 import time
 import traceback
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from pathlib import Path
 from types import ModuleType
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 import psutil
-from pyrogram import Client, errors, filters
+from pyrogram import Client, ContinuePropagation, StopPropagation, errors, filters
 from pyrogram.errors import FloodWait, MessageNotModified, UserNotParticipant
+from pyrogram.handlers import MessageHandler
 from pyrogram.types import Message
 from pyrogram.enums import ChatMembersFilter
 
 from utils.db import db
 
+from .isolate import IsolatedModule
+from .lazy import LazySpec, scan_module
 from .misc import modules_help, prefix, requirements_list
+from .router import router
 
 META_COMMENTS = re.compile(r"^ *# *meta +(\S+) *: *(.*?)\s*$", re.MULTILINE)
 interact_with_to_delete = []
 
+# seconds spent importing each module during the last load
+import_times: Dict[str, float] = {}
+# parsed meta comments by file path, reused while the file doesn't change
+_meta_cache: Dict[str, Tuple[float, Dict[str, str]]] = {}
+# modules registered by name only: their stub handlers and help entries
+lazy_modules: Dict[str, Tuple[List[Tuple[MessageHandler, int]], List[str]]] = {}
+_lazy_lock = asyncio.Lock()
+# modules running in a worker process: worker, stub handlers, help entries
+isolated_modules: Dict[
+    str, Tuple[IsolatedModule, List[Tuple[MessageHandler, int]], List[str]]
+] = {}
+# modules are imported concurrently, one pip install at a time
+_install_lock = threading.Lock()
+
 
 def time_formatter(milliseconds: int) -> str:
     """Time Formatter"""
@@ -219,6 +241,8 @@ def restart() -> None:
             music_bot_process.terminate()
         except psutil.NoSuchProcess:
             print("Music bot is not running.")
+    # atexit handlers don't run on exec, so write out pending changes first
+    db.flush()
     os.execvp(sys.executable, [sys.executable, "main.py"])
 
 
@@ -347,10 +371,17 @@ def import_library(library_name: str, package_name: str = None):
     try:
         return importlib.import_module(library_name)
     except ImportError as exc:
-        completed = subprocess.run(
-            [sys.executable, "-m", "pip", "install", "--upgrade", package_name],
-            check=True,
-        )
+        with _install_lock:
+            # another module may have installed it while we waited
+            importlib.invalidate_caches()
+            try:
+                return importlib.import_module(library_name)
+            except ImportError:
+                pass
+            completed = subprocess.run(
+                [sys.executable, "-m", "pip", "install", "--upgrade", package_name],
+                check=True,
+            )
         if completed.returncode != 0:
             raise AssertionError(
                 f"Failed to install library {package_name} (pip exited with code {completed.returncode})"
@@ -426,26 +457,66 @@ def resize_new_image(image_path, output_path, desired_width=None, desired_height
         os.remove(image_path)
 
 
+async def _install_requirements(packages: List[str], message: Message = None):
+    if message:
+        await message.edit(f"<b>Installing requirements: {' '.join(packages)}</b>")
+
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "pip",
+        "install",
+        "-U",
+        *packages,
+    )
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=120)
+    except asyncio.TimeoutError as e:
+        if message:
+            await message.edit(
+                "<b>Timeout while installed requirements."
+                + "Try to install them manually</b>"
+            )
+        raise TimeoutError("timeout while installing requirements") from e
+
+    if proc.returncode != 0:
+        if message:
+            await message.edit(
+                f"<b>Failed to install requirements (pip exited with code {proc.returncode}). "
+                f"Check logs for futher info</b>",
+            )
+        raise RuntimeError("failed to install requirements")
+    importlib.invalidate_caches()
+
+
 async def load_module(
     module_name: str,
     client: Client,
     message: Message = None,
     core=False,
-) -> ModuleType:
+) -> ModuleType | None:
     if module_name in modules_help and not core:
         await unload_module(module_name, client)
 
     path = f"modules.{'custom_modules.' if not core else ''}{module_name}"
 
-    with open(f"{path.replace('.', '/')}.py", encoding="utf-8") as f:
-        code = f.read()
-    meta = parse_meta_comments(code)
+    meta = read_meta(f"{path.replace('.', '/')}.py")
 
     packages = meta.get("requires", "").split()
     requirements_list.extend(packages)
 
+    if _is_isolated(meta, core):
+        # the worker imports the module, it can't fall back to installing
+        from utils.prewarm import is_installed
+
+        missing = [package for package in packages if not is_installed(package)]
+        if missing:
+            await _install_requirements(missing, message)
+        if _load_isolated(module_name, client, path):
+            return None
+
     try:
-        module = importlib.import_module(path)
+        module = _import_timed(path)
     except ImportError as e:
         if core:
             # Core modules shouldn't raise ImportError
@@ -454,64 +525,315 @@ async def load_module(
         if not packages:
             raise
 
-        if message:
-            await message.edit(f"<b>Installing requirements: {' '.join(packages)}</b>")
-
-        proc = await asyncio.create_subprocess_exec(
-            sys.executable,
-            "-m",
-            "pip",
-            "install",
-            "-U",
-            *packages,
-        )
         try:
-            await asyncio.wait_for(proc.wait(), timeout=120)
-        except asyncio.TimeoutError:
-            if message:
-                await message.edit(
-                    "<b>Timeout while installed requirements."
-                    + "Try to install them manually</b>"
-                )
-            raise TimeoutError("timeout while installing requirements") from e
+            await _install_requirements(packages, message)
+        except (TimeoutError, RuntimeError) as install_error:
+            raise install_error from e
 
-        if proc.returncode != 0:
-            if message:
-                await message.edit(
-                    f"<b>Failed to install requirements (pip exited with code {proc.returncode}). "
-                    f"Check logs for futher info</b>",
-                )
-            raise RuntimeError("failed to install requirements") from e
+        module = _import_timed(path)
+
+    _add_handlers(module, client)
+    module.__meta__ = meta
+
+    return module
 
-        module = importlib.import_module(path)
 
+def read_meta(file: str) -> Dict[str, str]:
+    """Parse meta comments of a module file, cached by modification time"""
+    mtime = os.path.getmtime(file)
+    cached = _meta_cache.get(file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(file, encoding="utf-8") as f:
+        meta = parse_meta_comments(f.read())
+    _meta_cache[file] = (mtime, meta)
+    return meta
+
+
+def _import_timed(path: str) -> ModuleType:
+    start = time.perf_counter()
+    try:
+        # through __import__ so the startup profiler can see it
+        __import__(path)
+        return sys.modules[path]
+    finally:
+        import_times[path.rsplit(".", 1)[-1]] = time.perf_counter() - start
+
+
+def _module_handlers(module: ModuleType) -> List[Tuple[MessageHandler, int]]:
+    handlers = []
     for _name, obj in vars(module).items():
         if isinstance(getattr(obj, "handlers", []), list):
-            for handler, group in getattr(obj, "handlers", []):
-                client.add_handler(handler, group)
+            handlers.extend(getattr(obj, "handlers", []))
+    return handlers
 
-    module.__meta__ = meta
 
-    return module
+def _add_handlers(module: ModuleType, client: Client):
+    for handler, group in _module_handlers(module):
+        router.add_handler(client, handler, group)
 
 
-async def unload_module(module_name: str, client: Client) -> bool:
-    path = "modules.custom_modules." + module_name
+def _scan_lazy(file: str, meta: Dict[str, str]) -> LazySpec | None:
+    if meta.get("lazy", "").lower() in ("no", "false"):
+        return None
+    with open(file, encoding="utf-8") as f:
+        return scan_module(f.read())
+
+
+def _add_stubs(
+    spec: LazySpec, client: Client, make_callback
+) -> List[Tuple[MessageHandler, int]]:
+    """Handlers for the commands of a module that isn't imported here"""
+    commands = {}
+    for command in spec.commands:
+        key = (command.prefixes, command.group, command.me)
+        commands.setdefault(key, []).extend(command.commands)
+
+    stubs = []
+    for (prefixes, group, me), names in commands.items():
+        flt = filters.command(
+            list(dict.fromkeys(names)), prefix if prefixes is None else list(prefixes)
+        )
+        if me:
+            flt &= filters.me
+        handler = MessageHandler(make_callback(group), flt)
+        router.add_handler(client, handler, group)
+        stubs.append((handler, group))
+    return stubs
+
+
+def _register_lazy(module_name: str, spec: LazySpec, client: Client, core: bool):
+    """Add help and stub handlers that import the module on first use"""
+    modules_help.update(spec.help)
+    callback = _lazy_callback(module_name, core)
+    stubs = _add_stubs(spec, client, lambda _group: callback)
+    lazy_modules[module_name] = (stubs, list(spec.help))
+
+
+def _is_isolated(meta: Dict[str, str], core: bool) -> bool:
+    return not core and meta.get("isolate", "").lower() == "process"
+
+
+def _load_isolated(module_name: str, client: Client, path: str) -> bool:
+    """Register a module whose worker process starts on its first command"""
+    file = f"{path.replace('.', '/')}.py"
+    with open(file, encoding="utf-8") as f:
+        spec = scan_module(f.read())
+    if spec is None or os.name != "posix":
+        logging.warning(
+            "Module %s can't run in a separate process, loading it normally",
+            module_name,
+        )
+        return False
+
+    worker = IsolatedModule(module_name, path, client)
+    # its worker writes to the database behind the cache's back
+    db.share()
+
+    def make_callback(group: int):
+        async def forward(_, message: Message):
+            await worker.forward(group, message)
+
+        return forward
+
+    modules_help.update(spec.help)
+    stubs = _add_stubs(spec, client, make_callback)
+    isolated_modules[module_name] = (worker, stubs, list(spec.help))
+    return True
+
+
+def _lazy_callback(module_name: str, core: bool):
+    path = f"modules.{'custom_modules.' if not core else ''}{module_name}"
+
+    async def activate(client: Client, message: Message):
+        async with _lazy_lock:
+            if module_name in lazy_modules:
+                stubs, help_names = lazy_modules.pop(module_name)
+                try:
+                    # real handlers go in before the stubs leave, so no
+                    # message slips through between the two
+                    await load_module(module_name, client, core=core)
+                except Exception:
+                    logging.warning(
+                        "Can't import module %s", module_name, exc_info=True
+                    )
+                    for name in help_names:
+                        modules_help.pop(name, None)
+                    return
+                finally:
+                    for handler, group in stubs:
+                        router.remove_handler(client, handler, group)
+                logging.info("Activated module %s", module_name)
+
+        module = sys.modules.get(path)
+        # every stub of the module gets the message, replay it only once;
+        # Message isn't hashable, so mark it instead of keeping a set
+        if module is None or getattr(message, "lazy_replayed", False):
+            return
+        message.lazy_replayed = True
+        await _replay(module, client, message)
+
+    return activate
+
+
+async def _replay(module: ModuleType, client: Client, message: Message):
+    """Dispatch a message that hit a stub to the module's own handlers"""
+    handlers = sorted(_module_handlers(module), key=lambda item: item[1])
+    last_group = None
+    for handler, group in handlers:
+        if group == last_group:
+            continue
+        if not await handler.check(client, message):
+            continue
+        last_group = group
+        try:
+            await handler.callback(client, message)
+        except StopPropagation:
+            return
+        except ContinuePropagation:
+            last_group = None
+
+
+async def load_modules(
+    files: List[Path], client: Client, workers: int = 8, lazy: bool = False
+) -> Tuple[int, int]:
+    """
+    Load modules at startup: meta comments are parsed and modules are imported
+    concurrently in a thread pool, then handlers are added in the given order.
+    With `lazy`, modules whose commands can be read statically are only
+    registered and get imported when one of their commands is first used.
+    :return: number of loaded and failed modules
+    """
+    loop = asyncio.get_running_loop()
+    import_paths = [".".join(file.with_suffix("").parts) for file in files]
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="loader") as pool:
+        metas = await asyncio.gather(
+            *(loop.run_in_executor(pool, read_meta, str(file)) for file in files)
+        )
+        specs = [None] * len(files)
+        if lazy:
+            specs = await asyncio.gather(
+                *(
+                    loop.run_in_executor(pool, _scan_lazy, str(file), meta)
+                    for file, meta in zip(files, metas)
+                )
+            )
+        # isolated modules are only imported by their worker process
+        isolated = {
+            i
+            for i, (file, meta) in enumerate(zip(files, metas))
+            if _is_isolated(meta, "custom_modules" not in file.parent.parts)
+        }
+        eager = [
+            i for i, spec in enumerate(specs) if spec is None and i not in isolated
+        ]
+        imported = await asyncio.gather(
+            *(
+                loop.run_in_executor(pool, _import_timed, import_paths[i])
+                for i in eager
+            ),
+            return_exceptions=True,
+        )
+        modules = dict(zip(eager, imported))
+
+    success_modules = 0
+    failed_modules = 0
+    for i, (file, meta, spec) in enumerate(zip(files, metas, specs)):
+        core = "custom_modules" not in file.parent.parts
+        packages = meta.get("requires", "").split()
+
+        if spec is not None and i not in isolated:
+            # .update reinstalls these, even for modules that weren't used yet
+            requirements_list.extend(packages)
+            _register_lazy(file.stem, spec, client, core)
+            success_modules += 1
+            continue
+
+        module = modules.get(i)
+        missing_requirements = (
+            isinstance(module, ImportError) and not core and bool(packages)
+        )
+        if i in isolated or missing_requirements:
+            # isolated modules and ones with missing requirements take
+            # the slow path through load_module()
+            try:
+                await load_module(file.stem, client, core=core)
+            except Exception:
+                logging.warning("Can't import module %s", file.stem, exc_info=True)
+                failed_modules += 1
+            else:
+                success_modules += 1
+            continue
+
+        if isinstance(module, BaseException):
+            logging.warning("Can't import module %s", file.stem, exc_info=module)
+            failed_modules += 1
+            continue
+
+        requirements_list.extend(packages)
+        _add_handlers(module, client)
+        module.__meta__ = meta
+        success_modules += 1
+
+    return success_modules, failed_modules
+
+
+async def unload_module(module_name: str, client: Client, core=False) -> bool:
+    if module_name in isolated_modules:
+        worker, stubs, help_names = isolated_modules.pop(module_name)
+        for handler, group in stubs:
+            router.remove_handler(client, handler, group)
+        for name in help_names:
+            modules_help.pop(name, None)
+        await worker.stop()
+        return True
+
+    if module_name in lazy_modules:
+        stubs, help_names = lazy_modules.pop(module_name)
+        for handler, group in stubs:
+            router.remove_handler(client, handler, group)
+        for name in help_names:
+            modules_help.pop(name, None)
+        return True
+
+    path = f"modules.{'custom_modules.' if not core else ''}{module_name}"
     if path not in sys.modules:
         return False
 
-    module = importlib.import_module(path)
+    module = sys.modules[path]
 
-    for _name, obj in vars(module).items():
-        for handler, group in getattr(obj, "handlers", []):
-            client.remove_handler(handler, group)
+    for handler, group in _module_handlers(module):
+        router.remove_handler(client, handler, group)
 
-    del modules_help[module_name]
+    modules_help.pop(module_name, None)
     del sys.modules[path]
 
     return True
 
 
+async def reload_module(module_name: str, client: Client, core=False):
+    """
+    Replace a loaded module with the current version of its file.
+    A module that was waiting for its first use stays lazy.
+    """
+    file = f"modules/{'custom_modules/' if not core else ''}{module_name}.py"
+    with open(file, encoding="utf-8") as f:
+        # don't drop the working version for one that can't even be compiled
+        compile(f.read(), file, "exec")
+
+    was_lazy = module_name in lazy_modules
+    await unload_module(module_name, client, core=core)
+    meta = read_meta(file)
+    spec = _scan_lazy(file, meta) if was_lazy else None
+    if spec is not None:
+        requirements_list.extend(meta.get("requires", "").split())
+        _register_lazy(module_name, spec, client, core)
+    else:
+        await load_module(module_name, client, core=core)
+
+
 def no_prefix(handler):
     def func(_, __, message):
         if message.text and not message.text.startswith(handler):
@@ -522,12 +844,7 @@ def no_prefix(handler):
 
 
 def parse_meta_comments(code: str) -> Dict[str, str]:
-    try:
-        groups = META_COMMENTS.search(code).groups()
-    except AttributeError:
-        return {}
-
-    return {groups[i]: groups[i + 1] for i in range(0, len(groups), 2)}
+    return {match.group(1): match.group(2) for match in META_COMMENTS.finditer(code)}
 
 
 def ReplyCheck(message: Message):
@@ -0,0 +1,138 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Startup timeline and import profiler.
+
+main.py imports this before anything else. The phase timeline is always
+recorded; with --profile-startup every import is timed as well, with self
+time (the module's own code) and cumulative time (including what it imports).
+"""
+
+import builtins
+import importlib.util
+import sys
+import threading
+import time
+from typing import Dict, List
+
+PROFILE_FLAG = "--profile-startup"
+# how many runs are kept in the database
+HISTORY_SIZE = 10
+
+_start = time.perf_counter()
+_last_mark = _start
+# (phase, seconds) in the order they happened
+phases: List[list] = []
+# module -> [self seconds, cumulative seconds]
+import_costs: Dict[str, List[float]] = {}
+
+
+def mark(phase: str):
+    """End a phase that started at the previous mark"""
+    global _last_mark
+    now = time.perf_counter()
+    phases.append([phase, now - _last_mark])
+    _last_mark = now
+
+
+class ImportProfiler:
+    def __init__(self):
+        self._original = builtins.__import__
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self):
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level:
+            package = (globals or {}).get("__package__") or ""
+            try:
+                resolved = importlib.util.resolve_name("." * level + name, package)
+            except (ImportError, ValueError):
+                resolved = name
+        else:
+            resolved = name
+        if resolved in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+
+        # imports of this thread in progress, each entry sums up its children
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            with self._lock:
+                cost = import_costs.setdefault(resolved, [0.0, 0.0])
+                cost[0] += cumulative - children
+                cost[1] += cumulative
+
+
+profiler = ImportProfiler() if PROFILE_FLAG in sys.argv else None
+if profiler is not None:
+    profiler.install()
+
+
+def finish(database, module_times: Dict[str, float], top: int = 15) -> dict:
+    """Stop profiling and store this run, newest first"""
+    if profiler is not None:
+        profiler.uninstall()
+
+    ranked = sorted(import_costs.items(), key=lambda item: item[1][0], reverse=True)
+    slowest = sorted(module_times.items(), key=lambda item: item[1], reverse=True)
+    run = {
+        "time": int(time.time()),
+        "total": time.perf_counter() - _start,
+        "phases": phases,
+        "modules": [[name, seconds] for name, seconds in slowest[:top]],
+        "imports": [[name, *cost] for name, cost in ranked[:top]],
+    }
+
+    runs = database.get("core.startup", "runs", [])
+    database.set("core.startup", "runs", [run, *runs][:HISTORY_SIZE])
+    return run
+
+
+def format_run(run: dict, previous: dict = None) -> str:
+    """Plain text report of a run, compared to the previous one if given"""
+    total = f"Startup took {run['total']:.2f}s"
+    if previous:
+        total += f" ({run['total'] - previous['total']:+.2f}s from previous)"
+    lines = [total]
+
+    offset = 0.0
+    for phase, seconds in run["phases"]:
+        lines.append(f"  {offset:7.2f}s  +{seconds * 1000:8.1f} ms  {phase}")
+        offset += seconds
+
+    if run["modules"]:
+        lines.append("Slowest modules:")
+        for name, seconds in run["modules"]:
+            lines.append(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    if run["imports"]:
+        lines.append("Imports (self / cumulative):")
+        for name, own, cumulative in run["imports"]:
+            lines.append(f"  {own * 1000:8.1f} / {cumulative * 1000:8.1f} ms  {name}")
+    return "\n".join(lines)
@@ -0,0 +1,153 @@
+#  Moon-Userbot - telegram userbot
+#  Copyright (C) 2020-present Moon Userbot Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Match a message against many triggers at once.
+
+Exact triggers are a set lookup. Word, prefix and substring triggers share
+one Aho-Corasick automaton, so a message is scanned once no matter how many
+of them a chat has. Regex triggers are tried one by one.
+"""
+
+import re
+from collections import deque
+from typing import Dict, List, Optional
+
+EXACT = "exact"
+WORD = "word"
+PREFIX = "prefix"
+CONTAINS = "contains"
+REGEX = "regex"
+TYPES = (EXACT, WORD, PREFIX, CONTAINS, REGEX)
+
+
+class Automaton:
+    """Aho-Corasick automaton over lowercase patterns"""
+
+    def __init__(self, patterns):
+        # node -> {char: node}, failure link and patterns ending at the node
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[str]] = [[]]
+
+        for pattern in patterns:
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.out[node].append(pattern)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text: str):
+        """Yield (start, pattern) of every occurrence"""
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for pattern in self.out[node]:
+                yield end - len(pattern) + 1, pattern
+
+
+def _is_word_char(text: str, index: int) -> bool:
+    return 0 <= index < len(text) and (text[index].isalnum() or text[index] == "_")
+
+
+class TriggerIndex:
+    """
+    Triggers of one chat. Changes are cheap, the automaton is rebuilt on the
+    first match after triggers were added or removed.
+    """
+
+    def __init__(self, triggers: Dict[str, str] = None):
+        self.exact = set()
+        # trigger -> type, for word / prefix / substring triggers
+        self.keywords: Dict[str, str] = {}
+        self.regexes: Dict[str, re.Pattern] = {}
+        self._automaton: Optional[Automaton] = None
+        for name, type_ in (triggers or {}).items():
+            self.add(name, type_)
+
+    def __len__(self):
+        return len(self.exact) + len(self.keywords) + len(self.regexes)
+
+    def add(self, name: str, type_: str = EXACT):
+        self.remove(name)
+        if type_ == REGEX:
+            self.regexes[name] = re.compile(name, re.IGNORECASE)
+        elif type_ in (WORD, PREFIX, CONTAINS):
+            self.keywords[name] = type_
+            self._automaton = None
+        else:
+            self.exact.add(name)
+
+    def remove(self, name: str):
+        self.exact.discard(name)
+        self.regexes.pop(name, None)
+        if self.keywords.pop(name, None) is not None:
+            self._automaton = None
+
+    def type_of(self, name: str) -> Optional[str]:
+        if name in self.exact:
+            return EXACT
+        if name in self.regexes:
+            return REGEX
+        return self.keywords.get(name)
+
+    def match(self, text: str) -> Optional[str]:
+        """
+        The trigger for a message: exact match first, then the longest
+        prefix, word or substring trigger, then the first matching regex
+        """
+        lowered = text.lower()
+        if lowered in self.exact:
+            return lowered
+
+        if self.keywords:
+            if self._automaton is None:
+                self._automaton = Automaton(self.keywords)
+            best = None
+            for start, pattern in self._automaton.search(lowered):
+                type_ = self.keywords[pattern]
+                if type_ == PREFIX and start != 0:
+                    continue
+                if type_ == WORD and (
+                    _is_word_char(lowered, start - 1)
+                    or _is_word_char(lowered, start + len(pattern))
+                ):
+                    continue
+                if best is None or len(pattern) > len(best):
+                    best = pattern
+            if best is not None:
+                return best
+
+        for name, regex in self.regexes.items():
+            if regex.search(text):
+                return name
+        return None